@@ -0,0 +1,106 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Compare the latency of cheap calls during a spike of sign-ins
+on the asyncio server, with and without the admission limit.
+Usage: python3 -m bench.admission [--fast 4] [--spike 16] [--limit 2]"""
+import os
+import tempfile
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from multiprocessing import Pool, Process
+from time import perf_counter, sleep
+
+from bench import prefork, utils
+from sni import app, db, rpc
+from sni import prefork as sni_prefork
+from sni import utils as sni_utils
+
+
+def prepare(filename, users):
+    db.bind_sqlite(filename)
+    for x in range(users):
+        rpc._sign_up('R{0:08d}'.format(x), 'Reader', '12345678')
+
+
+def serve(port, filename, threads, limit, queue):
+    db.bind_sqlite(filename)
+    sni_utils.admission.configure('auth', limit, queue)
+    app.serve_async(prefork.HOST, port, threads)
+
+
+def client(port, user, duration):
+    """Call get_user, signing in first until admitted."""
+    connection = HTTPConnection(prefork.HOST, port)
+    while True:
+        try:
+            session = prefork.call(connection, 'sign_in', 'R{0:08d}'.format(user), '12345678')
+            break
+        except RuntimeError:
+            sleep(0.1)
+    latencies = []
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        latencies.append(utils.timed(prefork.call, connection, 'get_user', session))
+    return latencies
+
+
+def spike(port, user, duration, backoff):
+    """Sign in again and again, backing off when rejected.
+    Return the latencies of the admitted calls and the rejections."""
+    connection = HTTPConnection(prefork.HOST, port)
+    latencies, rejected = [], 0
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        start = perf_counter()
+        try:
+            prefork.call(connection, 'sign_in', 'R{0:08d}'.format(user), '12345678')
+            latencies.append(perf_counter() - start)
+        except RuntimeError:
+            rejected += 1
+            sleep(backoff)
+    return latencies, rejected
+
+
+def run(limit, args, filename, port):
+    server = Process(target=serve, args=(port, filename, args.threads, limit, args.queue))
+    server.start()
+    try:
+        prefork.wait_port(port)
+        with Pool(args.fast + args.spike) as pool:
+            fast = [pool.apply_async(client, (port, x, args.duration))
+                    for x in range(args.fast)]
+            slow = [pool.apply_async(spike, (port, args.fast + x, args.duration, args.backoff))
+                    for x in range(args.spike)]
+            fast = sum((x.get() for x in fast), [])
+            slow = [x.get() for x in slow]
+        return (utils.summary(fast, args.duration),
+                utils.summary(sum((x[0] for x in slow), []), args.duration),
+                sum(x[1] for x in slow))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--fast', type=int, default=4)
+    parser.add_argument('--spike', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=2)
+    parser.add_argument('--queue', type=int, default=2)
+    parser.add_argument('--backoff', type=float, default=0.1)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+    filename = os.path.join(tempfile.mkdtemp(prefix='sni-bench-'), 'bench.db')
+    sni_prefork.run_once(prepare, filename, args.fast + args.spike)
+    for i, limit in enumerate((0, args.limit)):
+        fast, slow, rejected = run(limit, args, filename, args.port + i)
+        print('auth limit={0}:'.format(limit or 'none'))
+        print('  get_user: {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms'.format(**fast))
+        print('  sign_in:  {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms '
+              'rejected={0}'.format(rejected, **slow))
+
+
+if __name__ == '__main__':
+    main()
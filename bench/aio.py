@@ -0,0 +1,69 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Compare the latency of fast calls behind slow ones
+with bjoern and with the asyncio server.
+Usage: python3 -m bench.aio [--fast 8] [--slow 2] [--threads 8]"""
+import os
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Pool, Process
+
+from bench import prefork, rows, utils
+from sni import app, db, rpc
+from sni import prefork as sni_prefork
+
+
+def prepare(filename, articles, users):
+    db.bind_sqlite(filename)
+    rows.prepare(articles)
+    for x in range(users):
+        rpc._sign_up('R{0:08d}'.format(x), 'Reader', '12345678')
+
+
+def serve(port, mode, filename, threads):
+    db.bind_sqlite(filename)
+    if mode == 'asyncio':
+        app.serve_async(prefork.HOST, port, threads)
+    else:
+        app.serve_forever(prefork.HOST, port)
+
+
+def run(mode, fast, slow, duration, filename, port, threads):
+    """The fast clients get their user, the slow ones
+    get all the articles, which are streamed."""
+    server = Process(target=serve, args=(port, mode, filename, threads))
+    server.start()
+    try:
+        prefork.wait_port(port)
+        targets = [(port, x, 'get_user', duration) for x in range(fast)]
+        targets += [(port, fast + x, 'get_article', duration) for x in range(slow)]
+        with Pool(fast + slow) as pool:
+            results = pool.starmap(prefork.client, targets)
+        return (utils.summary(sum(results[:fast], []), duration),
+                utils.summary(sum(results[fast:], []), duration))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--fast', type=int, default=8)
+    parser.add_argument('--slow', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--articles', type=int, default=20000)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+    filename = os.path.join(tempfile.mkdtemp(prefix='sni-bench-'), 'bench.db')
+    sni_prefork.run_once(prepare, filename, args.articles, args.fast + args.slow)
+    for i, mode in enumerate(('bjoern', 'asyncio')):
+        fast, slow = run(mode, args.fast, args.slow, args.duration,
+                         filename, args.port + i, args.threads)
+        print('{0}:'.format(mode))
+        print('  fast: {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms'.format(**fast))
+        print('  slow: {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms'.format(**slow))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Generate a deterministic catalog with users and borrows.
+The same arguments and seed always give the same rows."""
+from datetime import datetime, timedelta
+from random import Random
+from uuid import uuid1
+
+from pony import orm
+
+from sni import bulk, db, rpc, utils
+
+WORDS = ('历史', '文化', '经济', '社会', '政治', '教育', '地方志', '考古', '文学', '哲学',
+         '宗教', '民族', '边疆', '城市', '乡村', '交通', '水利', '农业', '商业', '金融',
+         '科技', '医学', '法律', '军事', '外交', '艺术', '音乐', '建筑', '碑刻', '档案')
+NAMES = ('王', '李', '张', '刘', '陈', '杨', '黄', '赵', '周', '吴')
+# the borrows are dated from here, not from now
+EPOCH = datetime(2019, 1, 1)
+
+
+def journal(random, x, years, articles):
+    """The nested journal x in the format of the import."""
+    freq = random.choice((4, 6, 12))
+    return {'name': '{0}{1}研究'.format(random.choice(WORDS), x),
+            'issn': '{0:04d}-{1:03d}X'.format(x // 1000, x % 1000),
+            'isbn': 'CN{0:02d}-{1:04d}'.format(x // 10000, x % 10000),
+            'post': '{0}-{1}'.format(x // 1000 + 1, x % 1000),
+            'host': '{0}学会'.format(random.choice(WORDS)),
+            'addr': '北京',
+            'freq': freq,
+            'lang': '简体中文',
+            'subscribe': [{'year': EPOCH.year + y,
+                           'storage': [{'volume': EPOCH.year + y, 'number': n + 1,
+                                        'articles': [article(random) for _ in range(articles)]}
+                                       for n in range(freq)]}
+                          for y in range(years)]}
+
+
+def article(random):
+    keywords = random.sample(WORDS, 5)
+    return {'title': '{0}与{1}的{2}'.format(*keywords[:3]),
+            'author': random.choice(NAMES) + random.choice(WORDS)[0],
+            'pagenum': random.randint(1, 200),
+            'keyword1': keywords[0], 'keyword2': keywords[1], 'keyword3': keywords[2],
+            'keyword4': keywords[3], 'keyword5': keywords[4]}
+
+
+def catalog(journals, years=3, articles=10, seed=0):
+    random = Random(seed)
+    for x in range(journals): yield journal(random, x, years, articles)
+
+
+@orm.db_session
+def users(count, password='12345678'):
+    """Add the readers R00000000... sharing one hash,
+    each with a session as signed up."""
+    password = utils.hash_pw(password)
+    for x in range(count):
+        user = db.Reader(username='R{0:08d}'.format(x), nickname='读者{0}'.format(x), password=password)
+        db.Session(sessionid=uuid1().hex, shelflife=utils.new_shelflife(), user=user)
+
+
+def borrows(count, opened, seed=0):
+    """Add the returned borrows and then the open ones, which
+    are of distinct storages and of which some are overdue."""
+    random = Random(seed)
+    with orm.db_session:
+        readers = sorted(orm.select(x.id for x in db.Reader))
+        storages = sorted(orm.select(x.id for x in db.Storage))
+    rows = []
+    for x in range(count - opened):
+        borrowtime = EPOCH + timedelta(minutes=x)
+        rows.append((str(borrowtime), str(borrowtime + timedelta(days=31)),
+                     str(borrowtime + timedelta(days=random.randint(1, 60))),
+                     random.choice(readers), random.choice(storages)))
+    for x in random.sample(storages, min(opened, len(storages))):
+        borrowtime = EPOCH + timedelta(minutes=count + len(rows))
+        rows.append((str(borrowtime), str(borrowtime + timedelta(days=31)), None,
+                     random.choice(readers), x))
+    with orm.db_session:
+        connection = db.db.get_connection()
+        connection.executemany('INSERT INTO "Borrow" ("borrowtime", "agreedtime", "returntime", '
+                               '"user", "storage") VALUES (?, ?, ?, ?, ?)', rows)
+    rpc._check_borrow(repair=True)
+
+
+def populate(journals=50, years=3, articles=10, readers=100,
+             borrowed=10000, opened=500, seed=0):
+    """Fill the bound database and return the import report."""
+    report = bulk.import_catalog(catalog(journals, years, articles, seed))
+    users(readers)
+    borrows(borrowed, opened, seed)
+    return report
@@ -0,0 +1,97 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Measure the sign-in throughput and the latency of concurrent
+reads during a login storm, through bjoern and the asyncio server,
+with bcrypt inline and in the worker pool.
+Usage: python3 -m bench.login [--rounds 10] [--logins 8]"""
+import os
+import tempfile
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from multiprocessing import Pool, Process
+from time import perf_counter
+
+from bench import prefork, utils
+from sni import app, db, rpc
+from sni import prefork as sni_prefork
+from sni import utils as sni_utils
+
+
+def prepare(filename, users):
+    db.bind_sqlite(filename)
+    rpc._add_journal('当代亚太', '1007-161X', 'CN11-3706', '2-554',
+                     '中国社会科学院', '北京东城区', 6, '简体中文')
+    for x in range(users):
+        rpc._sign_up('R{0:08d}'.format(x), 'Reader', '12345678')
+
+
+def serve(port, mode, filename, rounds, workers, threads):
+    sni_utils.hasher.configure(rounds=rounds, workers=workers)
+    db.bind_sqlite(filename)
+    if mode == 'asyncio':
+        app.serve_async(prefork.HOST, port, threads)
+    else:
+        app.serve_forever(prefork.HOST, port)
+
+
+def login(port, user, duration):
+    """Sign in over one keep-alive connection until the deadline.
+    Return the latencies and the count of the busy rejections."""
+    connection = HTTPConnection(prefork.HOST, port)
+    latencies, rejected = [], 0
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        try:
+            latencies.append(utils.timed(prefork.call, connection, 'sign_in',
+                                         'R{0:08d}'.format(user), '12345678'))
+        except RuntimeError:
+            rejected += 1
+    return latencies, rejected
+
+
+def storm(mode, logins, users, duration, filename, port, rounds, workers, threads):
+    server = Process(target=serve, args=(port, mode, filename, rounds, workers, threads))
+    server.start()
+    try:
+        prefork.wait_port(port)
+        with Pool(logins + 1) as pool:
+            # the reader is the user after the ones signing in
+            reads = pool.apply_async(prefork.client, (port, users, 'get_journal', duration))
+            results = pool.starmap(login, [(port, x % users, duration) for x in range(logins)])
+            reads = reads.get()
+        latencies = sum((x[0] for x in results), [])
+        return {'login': utils.summary(latencies, duration),
+                'rejected': sum(x[1] for x in results),
+                'read': utils.summary(reads, duration)}
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--logins', type=int, default=8)
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=8100)
+    args = parser.parse_args()
+    filename = os.path.join(tempfile.mkdtemp(prefix='sni-bench-'), 'bench.db')
+    sni_prefork.run_once(prepare, filename, args.users + 1)
+    port = args.port
+    for mode in ('bjoern', 'asyncio'):
+        for workers in (0, args.workers):
+            result = storm(mode, args.logins, args.users, args.duration, filename,
+                           port, args.rounds, workers, args.threads)
+            port += 1
+            print('{0} workers={1}'.format(mode, workers))
+            print('  login: {rate:.1f}/s p99={p99:.1f}ms'.format(**result['login']),
+                  'rejected={0}'.format(result['rejected']))
+            print('  read:  {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms'
+                  .format(**result['read']))
+
+
+if __name__ == '__main__':
+    main()
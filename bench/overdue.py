@@ -0,0 +1,66 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Measure the overdue report over many returned borrows.
+Usage: python3 -m bench.overdue [--borrows 1000000] [--open 10000]"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from pony import orm
+
+from bench import utils
+from sni import db, rpc
+
+
+def prepare(borrows, opened, users, storages):
+    rpc._add_journal('当代亚太', '1007-161X', 'CN11-3706', '2-554',
+                     '中国社会科学院', '北京东城区', 6, '简体中文')
+    subscribe = rpc._add_subscribe(2019, 1)
+    with orm.db_session:
+        for x in range(storages): db.Storage(volume=x // 12, number=x % 12, subscribe=subscribe)
+        for x in range(users): db.Reader(username='R{0:08d}'.format(x), nickname='Reader', password='!')
+    now = datetime.now()
+    def _row(x):
+        borrowtime = now - timedelta(days=3650, minutes=-x)
+        if x < borrows - opened:
+            agreedtime = borrowtime + timedelta(days=31)
+            returntime = str(borrowtime + timedelta(days=7))
+        else:
+            # half of the open borrows are overdue
+            agreedtime, returntime = now + timedelta(days=x % 2 * 60 - 30), None
+        return str(borrowtime), str(agreedtime), returntime, x % users + 3, x % storages + 1
+    rows = map(_row, range(borrows))
+    with orm.db_session:
+        connection = db.db.get_connection()
+        connection.executemany('INSERT INTO Borrow (borrowtime, agreedtime, returntime, user, storage) '
+                               'VALUES (?, ?, ?, ?, ?)', rows)
+    rpc._check_borrow(repair=True)
+
+
+def timed(function, **kwargs):
+    start = perf_counter()
+    result = function(**kwargs)
+    return result, (perf_counter() - start) * 1000
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--borrows', type=int, default=1000000)
+    parser.add_argument('--open', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--storages', type=int, default=100000)
+    args = parser.parse_args()
+    utils.bind_tempfile()
+    start = perf_counter()
+    prepare(args.borrows, args.open, args.users, args.storages)
+    print('prepared {0} borrows in {1:.1f}s'.format(args.borrows, perf_counter() - start))
+    result, elapsed = timed(rpc._count_overdue)
+    print('summary: {0} {1:.1f}ms'.format(result, elapsed))
+    result, elapsed = timed(rpc._get_overdue, limit=100)
+    print('page:    {0} items {1:.1f}ms'.format(len(result), elapsed))
+    result, elapsed = timed(rpc._get_overdue, group=True, limit=100)
+    print('grouped: {0} users {1:.1f}ms'.format(len(result), elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Compare the throughput of one worker with the pre-fork mode.
+Usage: python3 -m bench.prefork [--workers 4] [--clients 16]"""
+import json
+import os
+import socket
+import tempfile
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from multiprocessing import Pool, Process
+from time import perf_counter, sleep
+
+from bench import utils
+from sni import app, db, prefork, rpc
+
+HOST = '127.0.0.1'
+
+
+def prepare(filename, journals, users):
+    db.bind_sqlite(filename)
+    for x in range(users):
+        rpc._sign_up('R{0:08d}'.format(x), 'Reader', '12345678')
+    for x in range(journals):
+        rpc._add_journal('期刊{0}'.format(x), '{0:04d}-000X'.format(x),
+                         'CN{0:02d}-{1:04d}'.format(x % 100, x), '{0}-{1}'.format(x % 99 + 1, x % 999),
+                         '中国社会科学院', '北京东城区', 6, '简体中文')
+
+
+def serve(port, workers, filename):
+    if workers <= 1: db.bind_sqlite(filename)
+    app.serve_forever(HOST, port, workers, filename)
+
+
+def call(connection, method, *params):
+    body = json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params})
+    connection.request('POST', '/', body, {'Content-Type': 'application/json'})
+    response = json.loads(connection.getresponse().read())
+    if 'error' in response: raise RuntimeError(response['error'])
+    return response['result']
+
+
+def client(port, user, method, duration):
+    """Call the method over one keep-alive connection.
+    Each client signs in as its own user."""
+    connection = HTTPConnection(HOST, port)
+    session = call(connection, 'sign_in', 'R{0:08d}'.format(user), '12345678')
+    latencies = []
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        latencies.append(utils.timed(call, connection, method, session))
+    return latencies
+
+
+def wait_port(port, timeout=30):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError('The server did not start.')
+
+
+def run(workers, clients, method, duration, filename, port):
+    server = Process(target=serve, args=(port, workers, filename))
+    server.start()
+    try:
+        wait_port(port)
+        with Pool(clients) as pool:
+            targets = [(port, x, method, duration) for x in range(clients)]
+            results = pool.starmap(client, targets)
+        return utils.summary(sum(results, []), duration)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--journals', type=int, default=100)
+    parser.add_argument('--method', default='get_journal')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+    filename = os.path.join(tempfile.mkdtemp(prefix='sni-bench-'), 'bench.db')
+    # the benchmark process never opens the database itself
+    prefork.run_once(prepare, filename, args.journals, args.clients)
+    for i, workers in enumerate((1, args.workers)):
+        result = run(workers, args.clients, args.method,
+                     args.duration, filename, args.port + i)
+        print('workers={0}: {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms'
+              .format(workers, **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Compare the per-row CPU and memory of reading the articles
+through the entities and as raw rows.
+Usage: python3 -m bench.rows [--articles 100000] [--rounds 5]"""
+import gc
+import json
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+from bench import utils
+from sni import bulk, db
+from sni import utils as sni_utils
+
+
+def prepare(articles):
+    storages = [{'volume': 1, 'number': x + 1, 'articles': [
+        {'title': '文章{0}'.format(y), 'author': '作者{0}'.format(y % 97),
+         'pagenum': y % 200 + 1, 'keyword1': '关键词', 'keyword2': '期刊'}
+        for y in range(x * 1000, min(x * 1000 + 1000, articles))]}
+        for x in range((articles + 999) // 1000)]
+    journal = {'name': '当代亚太', 'issn': '1007-161X', 'isbn': 'CN11-3706', 'post': '2-554',
+               'host': '中国社会科学院', 'addr': '北京东城区', 'freq': 6, 'lang': '简体中文',
+               'subscribe': [{'year': 2019, 'storage': storages}]}
+    bulk.import_catalog([journal])
+
+
+def entities():
+    return db.Article.select().map(lambda x: x.to_dict())
+
+
+def rows():
+    return db.Article.select_rows()
+
+
+def measure(function, rounds):
+    """Return the best seconds and the peak bytes of a call,
+    the result is encoded as the response would be."""
+    best = float('inf')
+    for _ in range(rounds):
+        gc.collect()
+        start = perf_counter()
+        json.dumps(function())
+        best = min(best, perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    json.dumps(function())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--articles', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    sni_utils.Page.size = args.articles
+    utils.bind_tempfile()
+    prepare(args.articles)
+    for function in (entities, rows):
+        elapsed, peak = measure(function, args.rounds)
+        print('{0:8}: {1:.2f}us/row {2:.0f}B/row'.format(
+            function.__name__, elapsed / args.articles * 1e6, peak / args.articles))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Measure the snapshot of an in-memory catalog under writes
+and the warm start from it against the cold one.
+Usage: python3 -m bench.snapshot [--journals 500] [--duration 5]"""
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from threading import Thread
+from time import perf_counter
+
+from bench import generate, utils
+from sni import db, rpc
+
+
+def restore(filename):
+    start = perf_counter()
+    db.bind_sqlite(':memory:', snapshot=filename)
+    print('warm start: {0:.3f}s'.format(perf_counter() - start))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--journals', type=int, default=500)
+    parser.add_argument('--borrows', type=int, default=100000)
+    parser.add_argument('--pages', type=int, default=1024)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--restore')
+    args = parser.parse_args()
+    if args.restore: return restore(args.restore)
+    filename = os.path.join(tempfile.mkdtemp(prefix='sni-bench-'), 'snapshot.db')
+    start = perf_counter()
+    db.bind_sqlite(':memory:', snapshot=filename)
+    generate.populate(args.journals, borrowed=args.borrows, opened=args.borrows // 20)
+    print('cold start: {0:.3f}s'.format(perf_counter() - start))
+    start = perf_counter()
+    print('idle:  {0} {1:.3f}s'.format(db.snapshot(filename, args.pages), perf_counter() - start))
+    # one writer and the snapshots in a loop, as the job thread
+    latencies, snapshots = [], []
+    deadline = perf_counter() + args.duration
+    def _write():
+        while perf_counter() < deadline:
+            latencies.append(utils.timed(rpc._set_journal, 1, used=str(len(latencies))))
+    writer = Thread(target=_write)
+    writer.start()
+    while perf_counter() < deadline:
+        snapshots.append(utils.timed(db.snapshot, filename, args.pages))
+    writer.join()
+    result = utils.summary(latencies, args.duration)
+    print('busy:  {0} snapshots max={1:.3f}s, writes {count} '
+          'p50={p50:.2f}ms p99={p99:.2f}ms max={2:.2f}ms'
+          .format(len(snapshots), max(snapshots), max(latencies) * 1000, **result))
+    # a fresh process, as a restarted server
+    subprocess.run([sys.executable, '-m', 'bench.snapshot', '--restore', filename], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Compare the read and write throughput of the pragma presets.
+Usage: python3 -m bench.sqlite [--readers 4] [--writers 1]"""
+from argparse import ArgumentParser
+from itertools import count
+
+from bench import utils
+from sni import db, prefork, rpc
+
+numbers = count()
+
+
+def write():
+    x = next(numbers)
+    # unique codes for up to 99000 journals
+    rpc._add_journal('期刊{0}'.format(x), '{0:04d}-{1:03d}X'.format(x // 1000, x % 1000),
+                     'CN{0:02d}-{1:04d}'.format(x // 10000, x % 10000),
+                     '{0}-{1}'.format(x // 1000 + 1, x % 1000),
+                     '中国社会科学院', '北京东城区', 6, '简体中文')
+
+
+def read():
+    rpc._get_journal(limit=100)
+
+
+def run(preset, readers, writers, duration):
+    utils.bind_tempfile(preset=preset)
+    for _ in range(100): write()
+    targets = [(write, ())] * writers + [(read, ())] * readers
+    results = utils.run_threads(targets, duration)
+    writes = utils.summary(sum(results[:writers], []), duration)
+    reads = utils.summary(sum(results[writers:], []), duration)
+    print('{0}: {1}'.format(preset, db.pragmas))
+    print('  write: {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms'.format(**writes))
+    print('  read:  {rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms'.format(**reads))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+    # each preset binds its own database in a child process
+    for preset in sorted(db.PRESETS):
+        prefork.run_once(run, preset, args.readers, args.writers, args.duration)
+
+
+if __name__ == '__main__':
+    main()
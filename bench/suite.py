@@ -0,0 +1,220 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+"""Run a weighted mix of calls on a generated catalog and report
+the throughput and the latency percentiles of each method.
+Usage: python3 -m bench.suite [--driver dispatch|wsgi] [--mix read=4,write=1]
+                              [--save base.json] [--compare base.json]"""
+import json
+from argparse import ArgumentParser
+from collections import defaultdict
+from random import Random
+from threading import Thread
+from time import perf_counter
+
+from jsonrpc import JSONRPCResponseManager
+from pony import orm
+
+from bench import generate, utils
+from sni import db, rpc
+from sni import utils as sni_utils
+
+
+class Context:
+    """The sessions and the sizes a thread makes the calls with."""
+    def __init__(self, index, threads, readers, session, admin, seed):
+        self.random = Random(seed + index)
+        self.reader = index
+        self.threads = threads
+        self.readers = readers
+        self.session = session
+        self.admin = admin
+        with orm.db_session:
+            self.journals = orm.count(x for x in db.Journal)
+            self.subscribes = orm.count(x for x in db.Subscribe)
+            self.storages = orm.count(x for x in db.Storage)
+            self.user = db.User.get(username=self.username(index)).id
+
+    @staticmethod
+    def username(x):
+        return 'R{0:08d}'.format(x)
+
+
+def sign_in(r, c):
+    # the first readers keep the sessions of the threads,
+    # the rest are split so that no two threads sign in one
+    username = c.username(r.randrange(c.reader + c.threads, c.readers, c.threads))
+    return 'sign_in', {'username': username, 'password': '12345678'}
+
+
+def get_journal(r, c):
+    return 'get_journal', {'sessionid': c.session, 'id': r.randint(1, c.journals)}
+
+
+def get_article(r, c):
+    return 'get_article', {'sessionid': c.session, 'storage': r.randint(1, c.storages), 'limit': 50}
+
+
+def get_journal_reverse(r, c):
+    return 'get_journal_reverse', {'sessionid': c.session, 'storage': r.randint(1, c.storages)}
+
+
+def get_article_advanced(r, c):
+    return 'get_article_advanced', {'sessionid': c.session, 'limit': 20,
+                                    'keywords': r.choice(generate.WORDS)}
+
+
+def get_journal_advanced(r, c):
+    return 'get_journal_advanced', {'sessionid': c.session, 'limit': 20,
+                                    'name': r.choice(generate.WORDS)}
+
+
+def get_subscribe_full(r, c):
+    return 'get_subscribe_full', {'sessionid': c.session, 'journal': r.randint(1, c.journals)}
+
+
+def get_storage_full(r, c):
+    return 'get_storage_full', {'sessionid': c.session, 'limit': 20,
+                                'subscribe': r.randint(1, c.subscribes)}
+
+
+def get_borrow_full(r, c):
+    return 'get_borrow_full', {'sessionid': c.session, 'user': c.user, 'limit': 20}
+
+
+def add_article(r, c):
+    return 'add_article', {'sessionid': c.admin, 'title': r.choice(generate.WORDS),
+                           'author': r.choice(generate.NAMES), 'pagenum': r.randint(1, 200),
+                           'storage': r.randint(1, c.storages)}
+
+
+def set_journal(r, c):
+    return 'set_journal', {'sessionid': c.admin, 'id': r.randint(1, c.journals),
+                           'used': r.choice(generate.WORDS)}
+
+
+CALLS = {'auth': (sign_in,),
+         'read': (get_journal, get_article, get_journal_reverse),
+         'search': (get_article_advanced, get_journal_advanced),
+         'full': (get_subscribe_full, get_storage_full, get_borrow_full),
+         'write': (add_article, set_journal)}
+
+
+def request(method, params):
+    return json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params})
+
+
+def encode(o):
+    if isinstance(o, sni_utils.Stream): return list(o)
+    return o.timestamp()
+
+
+class Dispatch:
+    """Call the dispatcher in process and encode the result."""
+    def __call__(self, method, params):
+        data = JSONRPCResponseManager.handle(request(method, params), rpc.d).data
+        if 'error' in data: raise RuntimeError(data['error'])
+        json.dumps(data, default=encode)
+        return data['result']
+
+
+class WSGI:
+    """Post the calls to the WSGI application."""
+    def __init__(self):
+        from werkzeug.test import Client
+        from sni import app
+        self.client = Client(app.application)
+
+    def __call__(self, method, params):
+        response = self.client.post('/', data=request(method, params),
+                                    content_type='application/json')
+        data = json.loads(response.get_data())
+        if 'error' in data: raise RuntimeError(data['error'])
+        return data['result']
+
+
+def parse_mix(text):
+    """Expand 'read=4,write=1' to the weighted calls."""
+    calls = []
+    for x in text.split(','):
+        category, _, weight = x.partition('=')
+        calls += CALLS[category.strip()] * int(weight or 1)
+    return calls
+
+
+def run(driver, contexts, calls, duration):
+    deadline = perf_counter() + duration
+    latencies = [defaultdict(list) for _ in contexts]
+    errors = [defaultdict(int) for _ in contexts]
+    def _loop(context, latencies, errors):
+        while perf_counter() < deadline:
+            method, params = context.random.choice(calls)(context.random, context)
+            start = perf_counter()
+            try:
+                driver(method, params)
+            except Exception:
+                errors[method] += 1
+            latencies[method].append(perf_counter() - start)
+    threads = [Thread(target=_loop, args=x) for x in zip(contexts, latencies, errors)]
+    for x in threads: x.start()
+    for x in threads: x.join()
+    result = {}
+    for method in sorted({k for x in latencies for k in x}):
+        values = sum((x[method] for x in latencies), [])
+        result[method] = utils.summary(values, duration)
+        result[method]['errors'] = sum(x[method] for x in errors)
+    return result
+
+
+def compare(result, baseline, threshold):
+    """Print the ratios to the baseline, flagging the regressions."""
+    for method, x in sorted(result.items()):
+        base = baseline['methods'].get(method)
+        if base is None or not base['rate']: continue
+        rate = x['rate'] / base['rate']
+        p99 = x['p99'] / base['p99'] if base['p99'] else 1.0
+        flag = ' !' if rate < 1 - threshold or p99 > 1 + threshold else ''
+        print('{0:24} rate x{1:.2f} p99 x{2:.2f}{3}'.format(method, rate, p99, flag))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--driver', choices=('dispatch', 'wsgi'), default='dispatch')
+    parser.add_argument('--mix', default='read=4,search=2,full=2,write=1,auth=1')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--journals', type=int, default=50)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--articles', type=int, default=10)
+    parser.add_argument('--readers', type=int, default=100)
+    parser.add_argument('--borrows', type=int, default=10000)
+    parser.add_argument('--open', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+    sni_utils.hasher.configure(rounds=args.rounds)
+    utils.bind_tempfile()
+    generate.populate(args.journals, args.years, args.articles, args.readers,
+                      args.borrows, args.open, args.seed)
+    driver = Dispatch() if args.driver == 'dispatch' else WSGI()
+    admin = driver('sign_in', {'username': 'A00000000', 'password': '12345678'})
+    sessions = [driver('sign_in', {'username': Context.username(x), 'password': '12345678'})
+                for x in range(args.threads)]
+    contexts = [Context(x, args.threads, args.readers, sessions[x], admin, args.seed)
+                for x in range(args.threads)]
+    result = run(driver, contexts, parse_mix(args.mix), args.duration)
+    for method, x in result.items():
+        print('{0:24} {rate:8.1f}/s p50={p50:.2f}ms p95={p95:.2f}ms '
+              'p99={p99:.2f}ms errors={errors}'.format(method, **x))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'methods': result}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f), args.threshold)
+
+
+if __name__ == '__main__':
+    main()
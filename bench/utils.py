@@ -0,0 +1,54 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from threading import Thread
+from time import perf_counter
+
+from sni import db
+
+
+def bind_tempfile(**kwargs):
+    """Bind the database to a fresh file.
+    A file is required to share it between threads."""
+    folder = tempfile.mkdtemp(prefix='sni-bench-')
+    filename = os.path.join(folder, 'bench.db')
+    db.bind_sqlite(filename, **kwargs)
+    return filename
+
+
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(q * len(values)))
+    return values[index]
+
+
+def summary(values, elapsed):
+    """Summarize the latencies in milliseconds."""
+    return {'count': len(values),
+            'rate': len(values) / elapsed,
+            'p50': percentile(values, 0.50) * 1000,
+            'p95': percentile(values, 0.95) * 1000,
+            'p99': percentile(values, 0.99) * 1000}
+
+
+def timed(function, *args, **kwargs):
+    start = perf_counter()
+    function(*args, **kwargs)
+    return perf_counter() - start
+
+
+def run_threads(targets, duration):
+    """Run each (function, args) in a thread until the deadline.
+    Return the latencies collected by each target."""
+    deadline = perf_counter() + duration
+    results = [[] for _ in targets]
+    def _loop(function, args, latencies):
+        while perf_counter() < deadline:
+            latencies.append(timed(function, *args))
+    threads = [Thread(target=_loop, args=(f, a, r))
+               for (f, a), r in zip(targets, results)]
+    for x in threads: x.start()
+    for x in threads: x.join()
+    return results
@@ -0,0 +1,193 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import unquote
+
+logger = logging.getLogger('sni')
+
+
+class BadRequest(Exception):
+    status = '400 Bad Request'
+
+
+class TooLarge(BadRequest):
+    status = '413 Payload Too Large'
+
+
+async def read_request(reader, limit=None):
+    """Read the head and the body of a request, the body is at most
+    limit bytes. Return None if the connection is closed before it."""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip(): raise BadRequest('Incomplete head.')
+        return None
+    except asyncio.LimitOverrunError:
+        raise BadRequest('Head too large.')
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+        headers = [x.split(':', 1) for x in lines[1:] if x]
+        headers = [(k.strip().lower(), v.strip()) for k, v in headers]
+        length = int(dict(headers).get('content-length', 0))
+    except ValueError:
+        raise BadRequest('Invalid head.')
+    if 'transfer-encoding' in dict(headers):
+        raise BadRequest('Content-Length required.')
+    if length < 0: raise BadRequest('Invalid head.')
+    if limit is not None and length > limit: raise TooLarge('Body too large.')
+    body = await reader.readexactly(length)
+    return method, target, version, headers, body
+
+
+def keep_alive(version, headers):
+    connection = dict(headers).get('connection', '').lower()
+    if version == 'HTTP/1.0': return connection == 'keep-alive'
+    return connection != 'close'
+
+
+class Server:
+    """Serve a WSGI application from an asyncio loop.
+    The requests are parsed on the loop and the application runs
+    on a bounded pool of threads, where each rpc method opens its
+    own db_session. At most threads + queue requests are in the pool,
+    the others wait on the loop. Larger bodies than max_body are
+    rejected with 413 before they are read."""
+    def __init__(self, application, host, port, threads=8, queue=64, timeout=60.0,
+                 max_body=67108864):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.queue = queue
+        self.timeout = timeout
+        self.max_body = max_body
+        self.executor = None
+        self.slots = None
+
+    def environ(self, method, target, version, headers, body):
+        path, _, query = target.partition('?')
+        environ = {'REQUEST_METHOD': method,
+                   'SCRIPT_NAME': '',
+                   'PATH_INFO': unquote(path, 'latin-1'),
+                   'QUERY_STRING': query,
+                   'CONTENT_LENGTH': str(len(body)),
+                   'SERVER_NAME': self.host,
+                   'SERVER_PORT': str(self.port),
+                   'SERVER_PROTOCOL': version,
+                   'wsgi.version': (1, 0),
+                   'wsgi.url_scheme': 'http',
+                   'wsgi.input': BytesIO(body),
+                   'wsgi.errors': sys.stderr,
+                   'wsgi.multithread': True,
+                   'wsgi.multiprocess': False,
+                   'wsgi.run_once': False}
+        for k, v in headers:
+            key = k.upper().replace('-', '_')
+            if key == 'CONTENT_TYPE': environ[key] = v
+            elif key != 'CONTENT_LENGTH': environ['HTTP_' + key] = v
+        return environ
+
+    def call(self, environ, send, keep=True, chunked=True):
+        """Run the application in a thread and send its response.
+        A body of one chunk is sent with its length, a longer one
+        in chunks, each sent before the next one is made."""
+        result = []
+        def start_response(status, headers, exc_info=None):
+            result[:] = status, headers
+        chunks = self.application(environ, start_response)
+        try:
+            body = (x for x in chunks if x)
+            first, second = next(body, b''), next(body, None)
+            if second is None or not chunked:
+                rest = b''.join(body) if second is not None else b''
+                send(self.response(*result, first + (second or b'') + rest, keep=keep))
+                return
+            send(self.head(*result, None, keep) + self.chunk(first) + self.chunk(second))
+            for x in body: send(self.chunk(x))
+            send(b'0\r\n\r\n')
+        finally:
+            if hasattr(chunks, 'close'): chunks.close()
+
+    @staticmethod
+    def head(status, headers, length, keep):
+        """Encode the head, the body is chunked without a length."""
+        lines = ['HTTP/1.1 ' + status]
+        lines += ['{0}: {1}'.format(k, v) for k, v in headers
+                  if k.lower() not in ('content-length', 'connection', 'transfer-encoding')]
+        if length is None:
+            lines.append('Transfer-Encoding: chunked')
+        elif not status.startswith(('204', '304')):
+            lines.append('Content-Length: {0}'.format(length))
+        lines.append('Connection: ' + ('keep-alive' if keep else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    @staticmethod
+    def chunk(data):
+        return '{0:x}\r\n'.format(len(data)).encode('latin-1') + data + b'\r\n'
+
+    @classmethod
+    def response(cls, status, headers, body, keep):
+        return cls.head(status, headers, len(body), keep) + body
+
+    @staticmethod
+    async def write(writer, data):
+        writer.write(data)
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        read_request(reader, self.max_body), self.timeout)
+                except BadRequest as e:
+                    body = str(e).encode('utf-8')
+                    writer.write(self.response(e.status, [], body, False))
+                    break
+                if request is None: break
+                keep = keep_alive(request[2], request[3])
+                sent = []
+                def send(data):
+                    # the thread waits for the client to take the data
+                    future = asyncio.run_coroutine_threadsafe(self.write(writer, data), loop)
+                    sent.append(future.result(self.timeout))
+                async with self.slots:
+                    try:
+                        await loop.run_in_executor(
+                            self.executor, self.call, self.environ(*request),
+                            send, keep, request[2] != 'HTTP/1.0')
+                    except ConnectionError:
+                        raise
+                    except Exception:
+                        logger.exception('The application failed.')
+                        # the connection is cut in the middle of a body
+                        if sent: break
+                        writer.write(self.response('500 Internal Server Error', [], b'', keep))
+                if not keep: break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.slots = asyncio.Semaphore(self.threads + self.queue)
+        server = loop.run_until_complete(
+            asyncio.start_server(self.handle, self.host, self.port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown()
+            loop.close()
@@ -1,15 +1,23 @@
 #!/usr/bin/env/python3
 # -*- coding: utf-8 -*-
 import json
+import zlib
 from configparser import ConfigParser
 from datetime import datetime
+from functools import partial
+from time import perf_counter
+from types import GeneratorType
 
 import bjoern
 from jsonrpc import JSONRPCResponseManager
+from jsonrpc.jsonrpc import JSONRPCRequest
+from jsonrpc.jsonrpc2 import JSONRPC20BatchRequest, JSONRPC20BatchResponse
+from jsonrpc.jsonrpc2 import JSONRPC20Response
 from jsonrpc.utils import JSONSerializable
+from pony import orm
 from werkzeug.wrappers import Request, Response
 
-from sni import db, rpc
+from sni import aio, db, jobs, metrics, prefork, rpc, timing, utils
 
 
 class JsonEncoder(json.JSONEncoder):
@@ -18,7 +26,7 @@ class JsonEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime):
             return o.timestamp()
-        return super().default(0)
+        return super().default(o)
 
     @classmethod
     def dumps(cls, o):
@@ -29,20 +37,194 @@ class JsonEncoder(json.JSONEncoder):
         return json.loads(s)
 
 
+def iter_json(data, encoder=JsonEncoder()):
+    """Encode the response data incrementally.
+    Results of lists, streams or generators are encoded item by item,
+    a failure in the middle closes the result and adds the error."""
+    if isinstance(data, list):
+        yield '['
+        for i, x in enumerate(data):
+            yield ', ' if i else ''
+            yield from iter_json(x)
+        yield ']'
+        return
+    result = data.get('result')
+    if not isinstance(result, (list, utils.Encoded, utils.Stream, GeneratorType)):
+        yield encoder.encode(data)
+        return
+    head = {k: v for k, v in data.items() if k != 'result'}
+    if isinstance(result, utils.Encoded):
+        yield encoder.encode(head)[:-1] + ', "result": ' + result + '}'
+        return
+    yield encoder.encode(head)[:-1] + ', "result": ['
+    try:
+        for i, x in enumerate(result):
+            yield ', ' if i else ''
+            yield encoder.encode(x)
+    except Exception as e:
+        metrics.logger.error('%s %s', type(e), e.args)
+        error = utils.Fault(500, 'Internal server error: {0}', e.args).error._data
+        yield '], "error": ' + encoder.encode(error) + '}'
+        return
+    yield ']}'
+
+
+def iter_chunks(data, size=65536):
+    """Group the encoded pieces into chunks."""
+    chunk = []
+    length = 0
+    for x in iter_json(data):
+        chunk.append(x)
+        length += len(x)
+        if length >= size:
+            yield ''.join(chunk).encode('utf-8')
+            chunk, length = [], 0
+    yield ''.join(chunk).encode('utf-8')
+
+
+def close_streams(data):
+    """End the streams of the response that were never sent."""
+    for x in data if isinstance(data, list) else [data]:
+        if isinstance(x.get('result'), utils.Stream): x['result'].close()
+
+
+def iter_gzip(chunks):
+    """Compress the chunks as one gzip stream."""
+    compressor = zlib.compressobj(wbits=31)
+    for x in chunks:
+        x = compressor.compress(x)
+        if x: yield x
+    yield compressor.flush()
+
+
+def handle(data, atomic=False):
+    """Handle the request, batches run in one db_session.
+    Invalid requests are left to the response manager."""
+    try:
+        request = JSONRPCRequest.from_json(data)
+    except Exception:
+        return JSONRPCResponseManager.handle(data, rpc.d)
+    if isinstance(request, JSONRPC20BatchRequest):
+        return handle_batch(request.requests, atomic)
+    return JSONRPCResponseManager.handle_request(request, rpc.d)
+
+
+def handle_batch(requests, atomic=False):
+    """Run the calls of the batch with one commit. Each call runs in
+    a savepoint, a failed one is rolled back alone, unless the batch
+    is atomic, which is then rolled back as a whole."""
+    responses = []
+    with db.batch():
+        for x in requests:
+            with db.savepoint() as rollback:
+                response = handle_call(x)
+                if response.error: rollback()
+            responses.append(response)
+            if response.error and atomic:
+                orm.rollback()
+                break
+    if atomic and responses and responses[-1].error:
+        failed = len(responses) - 1
+        error = utils.Fault(409, 'Batch rolled back.').error._data
+        responses = [responses[i] if i == failed else JSONRPC20Response(_id=x._id, error=error)
+                     for i, x in enumerate(requests)]
+    responses = [y for x, y in zip(requests, responses) if not x.is_notification]
+    return JSONRPC20BatchResponse(*responses) if responses else None
+
+
+def handle_call(request):
+    """Handle a call of the batch and flush its writes. A notification
+    gets its response as well, to roll it back if it failed."""
+    notification, request.is_notification = request.is_notification, False
+    try:
+        response = JSONRPCResponseManager.handle_request(request, rpc.d)
+    finally:
+        request.is_notification = notification
+    try:
+        if not response.error: utils.catch_error(orm.flush)()
+    except utils.Fault as e:
+        response = JSONRPC20Response(_id=request._id, error=e.error._data)
+    return response
+
+
 @Request.application
 def application(request):
-    print('Receive message: {0}'.format(json.loads(request.data)))
-    response = JSONRPCResponseManager.handle(request.data, rpc.d)
-    print('Response message: {0}'.format(response.json))
-    return Response(response.json, mimetype='application/json')
+    if request.path == '/metrics':
+        data = json.dumps(metrics.registry.snapshot())
+        return Response(data, mimetype='application/json')
+    atomic = request.args.get('atomic', rpc.cfg.get('batch', 'atomic', fallback='no'))
+    if timing.enabled: timing.begin()
+    with metrics.registry.request():
+        response = handle(request.data, atomic in ('1', 'yes', 'true', 'on'))
+    chunks = iter_chunks(response.data) if response is not None else []
+    headers = {}
+    if timing.enabled:
+        chunks, headers['X-Profile'] = profile(chunks)
+    if response is None: return Response(status=204, headers=headers)
+    if 'gzip' in request.accept_encodings:
+        chunks = iter_gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    result = Response(chunks, mimetype='application/json', headers=headers)
+    result.call_on_close(partial(close_streams, response.data))
+    return result
+
+
+def profile(chunks):
+    """Encode the whole response to time it.
+    Return the chunks and the spans of the calls."""
+    start = perf_counter()
+    chunks = list(chunks)
+    return chunks, json.dumps(timing.end(perf_counter() - start))
+
+
+# inside the metrics, which count the rejected calls
+utils.admission.instrument(rpc.d)
+metrics.registry.instrument(rpc.d)
+metrics.registry.gauges.update(sessions=utils.sessions.stats,
+                               hasher=utils.hasher.stats,
+                               profile=timing.registry.stats,
+                               jobs=jobs.scheduler.stats,
+                               cache=utils.responses.stats,
+                               admission=utils.admission.stats)
+utils.responses.encode = JsonEncoder().encode
+timing.instrument(rpc.d)
+jobs.scheduler.add('overdue', rpc.cfg.getfloat('jobs', 'overdue', fallback=3600),
+                   rpc._count_overdue)
+jobs.scheduler.add('sessions', rpc.cfg.getfloat('jobs', 'sessions', fallback=600),
+                   partial(utils.reap_sessions,
+                           rpc.cfg.getint('session', 'reap_batch', fallback=500)))
+if rpc.cfg.get('sqlite', 'snapshot', fallback=''):
+    jobs.scheduler.add('snapshot', rpc.cfg.getfloat('jobs', 'snapshot', fallback=300),
+                       partial(db.snapshot, rpc.cfg.get('sqlite', 'snapshot')))
 
 
-def serve_forever(host, port):
+def serve_forever(host, port, workers=1, filename=None):
     JSONSerializable.serialize = JsonEncoder.dumps
     JSONSerializable.deserialize = JsonEncoder.loads
     # bjoern is a fast and lightweight WSGI server
     # using it without any web server is convenient
     socket = bjoern.bind_and_listen(host, port)
+    if workers <= 1:
+        bjoern.server_run(socket, application)
+        return
+    # the workers share the listening socket
+    # and bind the database after the fork
+    prefork.Supervisor(workers, serve_worker, socket, filename).run()
+
+
+def serve_async(host, port, threads=8, queue=64, max_body=67108864):
+    """Serve from an asyncio loop with a pool of threads,
+    so that a slow call does not block the others."""
+    JSONSerializable.serialize = JsonEncoder.dumps
+    JSONSerializable.deserialize = JsonEncoder.loads
+    aio.Server(application, host, port, threads, queue, max_body=max_body).run()
+
+
+def serve_worker(index, socket, filename):
+    db.bind_sqlite(filename)
+    metrics.start_logging()
+    # the jobs work on the shared database, one worker runs them
+    if index == 0: jobs.scheduler.start()
     bjoern.server_run(socket, application)
 
 
@@ -51,8 +233,32 @@ def start_application():
     cfg.read('../settings.ini')
     host = cfg['server']['host']
     port = cfg['server']['port']
-    db.bind_sqlite(cfg['sqlite']['path'])
-    serve_forever(host, int(port))
+    workers = cfg.getint('server', 'workers', fallback=1)
+    filename = cfg['sqlite']['path']
+    mode = cfg.get('server', 'mode', fallback='bjoern')
+    if mode == 'asyncio' and filename in (':memory:', ':sharedmemory:'):
+        # the table locks of a shared cache fail the concurrent reads
+        print('The in-memory database can not be shared by threads, use bjoern.')
+        mode = 'bjoern'
+    if mode == 'asyncio':
+        db.bind_sqlite(filename)
+        metrics.start_logging()
+        jobs.scheduler.start()
+        serve_async(host, int(port), cfg.getint('server', 'threads', fallback=8),
+                    cfg.getint('server', 'queue', fallback=64),
+                    cfg.getint('server', 'max_body', fallback=67108864))
+        return
+    if workers > 1 and filename == ':memory:':
+        print('The in-memory database can not be shared, use one worker.')
+        workers = 1
+    if workers > 1:
+        # create the schema once, the supervisor never opens it
+        prefork.run_once(db.bind_sqlite, filename)
+    else:
+        db.bind_sqlite(filename)
+        metrics.start_logging()
+        jobs.scheduler.start()
+    serve_forever(host, int(port), workers, filename)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,435 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import json
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+
+from pony import orm
+
+from sni import db, rpc
+
+COLUMNS = {
+    'User': ('classtype', 'username', 'nickname', 'password',
+             'forename', 'lastname', 'mailaddr', 'phonenum'),
+    'Journal': ('name', 'issn', 'isbn', 'post', 'host',
+                'addr', 'freq', 'lang', 'hist', 'used'),
+    'Subscribe': ('year', 'journal'),
+    'Storage': ('volume', 'number', 'subscribe'),
+    'Article': ('title', 'author', 'pagenum',
+                'keyword1', 'keyword2', 'keyword3',
+                'keyword4', 'keyword5', 'storage'),
+    'Borrow': ('borrowtime', 'agreedtime', 'returntime', 'user', 'storage'),
+}
+REQUIRED = {
+    'User': {'classtype': str, 'username': str, 'nickname': str},
+    'Journal': {'name': str, 'issn': str, 'isbn': str, 'post': str,
+                'host': str, 'addr': str, 'freq': int, 'lang': str},
+    'Subscribe': {'year': int},
+    'Storage': {'volume': int, 'number': int},
+    'Article': {'title': str, 'author': str, 'pagenum': int},
+    'Borrow': {'borrowtime': datetime, 'agreedtime': datetime},
+}
+OPTIONAL = {
+    'User': {'forename': str, 'lastname': str, 'mailaddr': str, 'phonenum': str},
+    'Journal': {'hist': int, 'used': str},
+    'Subscribe': {},
+    'Storage': {},
+    'Article': {'keyword1': str, 'keyword2': str, 'keyword3': str,
+                'keyword4': str, 'keyword5': str},
+    'Borrow': {'returntime': datetime},
+}
+FORMATS = ('issn', 'isbn', 'post')
+# the natural keys to merge the records of an export
+KEYS = {
+    'User': ('username',),
+    'Journal': ('issn',),
+    'Subscribe': ('year', 'journal'),
+    'Storage': ('volume', 'number', 'subscribe'),
+    'Article': ('title', 'author', 'pagenum', 'storage'),
+    'Borrow': COLUMNS['Borrow'],
+}
+# the tables whose keys may repeat, e.g. two borrows of a copy on one day,
+# the n-th record of a key is merged with the n-th row of it
+REPEATED = ('Borrow',)
+REFERENCES = {
+    'Subscribe': {'journal': 'Journal'},
+    'Storage': {'subscribe': 'Subscribe'},
+    'Article': {'storage': 'Storage'},
+    'Borrow': {'user': 'User', 'storage': 'Storage'},
+}
+ROLES = ('Admin', 'Reader', 'Guest')
+# password hashes are never exported,
+# imported users can not sign in until it is reset
+HIDDEN = ('password',)
+UNUSABLE = '!'
+
+
+def check_kind(value, kind):
+    if kind is datetime:
+        try:
+            return bool(datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S'))
+        except (TypeError, ValueError):
+            return False
+    return isinstance(value, kind) and not isinstance(value, bool)
+
+
+def validate(table, record, **keys):
+    """Check the record like the entity would do.
+    Return the row of the table, or raise ValueError."""
+    if not isinstance(record, dict):
+        raise ValueError('Invalid record.')
+    record = dict(record, **keys)
+    for key, kind in REQUIRED[table].items():
+        value = record.get(key)
+        if not check_kind(value, kind) or value == '':
+            raise ValueError('Invalid {0}.'.format(key))
+    for key, kind in OPTIONAL[table].items():
+        value = record.get(key)
+        if value is not None and not check_kind(value, kind):
+            raise ValueError('Invalid {0}.'.format(key))
+    for key in FORMATS:
+        check = getattr(rpc, 'check_' + key)
+        if key in record and not check(record[key]):
+            raise ValueError('Invalid format: {0}.'.format(key.upper()))
+    if table == 'User' and record['classtype'] not in ROLES:
+        raise ValueError('Invalid classtype.')
+    row = []
+    for key in COLUMNS[table]:
+        value = record.get(key)
+        if value is None and OPTIONAL[table].get(key) is str: value = ''
+        row.append(value)
+    return row
+
+
+def iter_journals(lines):
+    """Iterate the journals of a JSON document or NDJSON lines.
+    Both the shape of tests/test.json and one journal per line
+    are accepted, so are the flat records of an export."""
+    lines = iter(lines)
+    for line in lines:
+        if not line.strip(): continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = json.loads(line + ''.join(lines))
+        yield from unwrap(record)
+
+
+def unwrap(record):
+    """Get the journals of a catalog, an iterable or a single journal."""
+    if isinstance(record, dict):
+        return record['journals'] if 'journals' in record else [record]
+    if isinstance(record, str) or not hasattr(record, '__iter__'):
+        return [record]
+    return record
+
+
+def iter_chunks(journals, size):
+    """Group the journals so that each chunk holds
+    about the given number of rows."""
+    chunk, rows = [], 0
+    for i, x in enumerate(journals):
+        chunk.append((i, x))
+        rows += 1 + count_rows(x)
+        if rows >= size:
+            yield chunk
+            chunk, rows = [], 0
+    if chunk: yield chunk
+
+
+def count_rows(journal):
+    if is_flat(journal): return 0
+    storage = [y for x in children(journal, 'subscribe')
+               for y in children(x, 'storage')]
+    articles = [y for x in storage for y in children(x, 'articles')]
+    return len(children(journal, 'subscribe')) + len(storage) + len(articles)
+
+
+def children(record, key):
+    value = record.get(key) if isinstance(record, dict) else None
+    return value if isinstance(value, list) else []
+
+
+def is_flat(record):
+    return isinstance(record, dict) and 'entity' in record
+
+
+class Importer:
+    """Insert the nested catalog by chunks.
+    Each chunk is one transaction, foreign keys are resolved
+    in memory and errors are reported per record."""
+    def __init__(self):
+        self.counts = dict.fromkeys(COLUMNS, 0)
+        self.errors = []
+        # ids of the exported records, to resolve the flat references
+        self.maps = {x: {} for x in ('User', 'Journal', 'Subscribe', 'Storage')}
+        # ids of the rows of REPEATED already merged or inserted
+        self.claimed = set()
+
+    def select(self, sql, values):
+        """Run the IN query in batches of parameters."""
+        values = list(values)
+        for i in range(0, len(values), 500):
+            batch = values[i:i + 500]
+            marks = ', '.join('?' * len(batch))
+            yield from self.connection.execute(sql.format(marks), batch)
+
+    def next_ids(self):
+        sql = 'SELECT coalesce(max(id), 0) FROM "{0}"'
+        return {x: self.connection.execute(sql.format(x)).fetchone()[0]
+                for x in COLUMNS}
+
+    def error(self, path, e):
+        self.errors.append({'record': path, 'error': str(e)})
+
+    @orm.db_session(immediate=True)
+    def run(self, chunk):
+        self.connection = db.db.get_connection()
+        self.ids = self.next_ids()
+        self.rows = {x: [] for x in COLUMNS}
+        self.keys = {x: {} for x in COLUMNS}
+        self.resolve([x for x in chunk if not is_flat(x[1])])
+        for i, x in chunk:
+            if is_flat(x): self.resolve_record(i, x)
+        for table, rows in self.rows.items():
+            columns = ('id',) + COLUMNS[table]
+            sql = 'INSERT INTO "{0}" ({1}) VALUES ({2})'
+            sql = sql.format(table, ', '.join('"{0}"'.format(x) for x in columns),
+                             ', '.join('?' * len(columns)))
+            self.connection.executemany(sql, rows)
+            self.counts[table] += len(rows)
+
+    def new_id(self, table, row):
+        self.ids[table] += 1
+        self.rows[table].append([self.ids[table]] + row)
+        return self.ids[table]
+
+    def resolve(self, chunk):
+        rows = {}
+        for i, x in chunk:
+            try:
+                rows[i] = validate('Journal', x)
+            except ValueError as e:
+                self.error('journals[{0}]'.format(i), e)
+        sql = 'SELECT issn, id FROM "Journal" WHERE issn IN ({0})'
+        journals = dict(self.select(sql, {x[1] for x in rows.values()}))
+        taken = set()
+        sql = 'SELECT isbn FROM "Journal" WHERE isbn IN ({0})'
+        taken.update(x for x, in self.select(sql, {x[2] for x in rows.values()}))
+        sql = 'SELECT post FROM "Journal" WHERE post IN ({0})'
+        taken.update(x for x, in self.select(sql, {x[3] for x in rows.values()}))
+        for i, x in chunk:
+            if i not in rows: continue
+            row = rows[i]
+            path = 'journals[{0}]'.format(i)
+            if row[1] not in journals:
+                if row[2] in taken or row[3] in taken:
+                    self.error(path, 'Duplicate ISBN or POST.')
+                    continue
+                taken.update(row[2:4])
+                journals[row[1]] = self.new_id('Journal', row)
+            self.resolve_subscribe(x, journals[row[1]], path)
+
+    def resolve_subscribe(self, journal, id, path):
+        sql = 'SELECT year, id FROM "Subscribe" WHERE journal = ?'
+        existing = dict(self.connection.execute(sql, (id,)))
+        for i, x in enumerate(children(journal, 'subscribe')):
+            try:
+                row = validate('Subscribe', x, journal=id)
+            except ValueError as e:
+                self.error('{0}.subscribe[{1}]'.format(path, i), e)
+                continue
+            if row[0] not in existing:
+                existing[row[0]] = self.new_id('Subscribe', row)
+            sub_path = '{0}.subscribe[{1}]'.format(path, i)
+            self.resolve_storage(x, existing[row[0]], sub_path)
+
+    def resolve_storage(self, subscribe, id, path):
+        sql = 'SELECT volume, number, id FROM "Storage" WHERE subscribe = ?'
+        existing = {(x[0], x[1]): x[2] for x in self.connection.execute(sql, (id,))}
+        for i, x in enumerate(children(subscribe, 'storage')):
+            try:
+                row = validate('Storage', x, subscribe=id)
+            except ValueError as e:
+                self.error('{0}.storage[{1}]'.format(path, i), e)
+                continue
+            key = row[0], row[1]
+            if key not in existing:
+                existing[key] = self.new_id('Storage', row)
+                articles = set()
+            else:
+                sql = 'SELECT title, author, pagenum FROM "Article" WHERE storage = ?'
+                articles = set(self.connection.execute(sql, (existing[key],)))
+            sub_path = '{0}.storage[{1}]'.format(path, i)
+            self.resolve_articles(x, existing[key], articles, sub_path)
+
+    def resolve_articles(self, storage, id, articles, path):
+        """Add the articles not yet in the storage,
+        so that importing the catalog again is harmless."""
+        for i, x in enumerate(children(storage, 'articles')):
+            try:
+                row = validate('Article', x, storage=id)
+            except ValueError as e:
+                self.error('{0}.articles[{1}]'.format(path, i), e)
+                continue
+            if tuple(row[:3]) in articles: continue
+            articles.add(tuple(row[:3]))
+            self.new_id('Article', row)
+
+    def resolve_record(self, i, record):
+        """Merge a flat record of an export by its natural key.
+        The records must come after the ones they refer to."""
+        path = 'records[{0}]'.format(i)
+        table = record['entity']
+        try:
+            if table not in KEYS:
+                raise ValueError('Invalid entity.')
+            keys = {}
+            for key, parent in REFERENCES.get(table, {}).items():
+                if record.get(key) not in self.maps[parent]:
+                    raise ValueError('Unknown {0}.'.format(key))
+                keys[key] = self.maps[parent][record[key]]
+            if table == 'User': keys['password'] = UNUSABLE
+            row = validate(table, record, **keys)
+            id = self.find(table, row)
+        except ValueError as e:
+            self.error(path, e)
+            return
+        if table in self.maps:
+            self.maps[table][record.get('id')] = id
+
+    def find(self, table, row):
+        """Get the id of the row with the same natural key.
+        The row is inserted if there is none."""
+        columns = COLUMNS[table]
+        key = tuple(row[columns.index(x)] for x in KEYS[table])
+        if table in REPEATED:
+            return self.find_repeated(table, row, key)
+        if key not in self.keys[table]:
+            sql = 'SELECT id FROM "{0}" WHERE '.format(table)
+            sql += ' AND '.join('"{0}" = ?'.format(x) for x in KEYS[table])
+            found = self.connection.execute(sql, key).fetchone()
+            if found is None and table == 'Journal':
+                self.check_journal(row)
+            self.keys[table][key] = found[0] if found else self.new_id(table, row)
+        return self.keys[table][key]
+
+    def find_repeated(self, table, row, key):
+        """Get the first row of the key not merged yet, or insert one."""
+        sql = 'SELECT id FROM "{0}" WHERE '.format(table)
+        sql += ' AND '.join('"{0}" IS ?'.format(x) for x in KEYS[table])
+        found = [x for x, in self.connection.execute(sql + ' ORDER BY id', key)
+                 if x not in self.claimed]
+        id = found[0] if found else self.new_id(table, row)
+        self.claimed.add(id)
+        return id
+
+    def check_journal(self, row):
+        isbn, post = row[2:4]
+        sql = 'SELECT count(*) FROM "Journal" WHERE isbn = ? OR post = ?'
+        pending = {x for y in self.rows['Journal'] for x in y[3:5]}
+        if isbn in pending or post in pending or \
+                self.connection.execute(sql, (isbn, post)).fetchone()[0]:
+            raise ValueError('Duplicate ISBN or POST.')
+
+    def report(self):
+        return {'counts': self.counts, 'errors': self.errors}
+
+
+def import_catalog(journals, size=10000):
+    """Import the nested journals in chunks of about the size rows.
+    Return the inserted counts and the per-record errors."""
+    importer = Importer()
+    for chunk in iter_chunks(unwrap(journals), size):
+        importer.run(chunk)
+    # the rows are inserted without the borrow counters
+    if importer.counts['Borrow']: rpc._check_borrow(repair=True)
+    return importer.report()
+
+
+def connect():
+    """Open another read-only connection to the database. An in-memory
+    database is only seen by the connections of the server, which would
+    run the other requests in the transaction of the export, or be locked
+    by it in a shared cache, so it is refused."""
+    filename = db.db.provider.pool.filename
+    if filename == ':memory:' or 'mode=memory' in filename:
+        raise ValueError('The export needs a file database.')
+    if not filename.startswith('file:'):
+        filename = Path(filename).resolve().as_uri() + '?mode=ro'
+    return sqlite3.connect(filename, uri=True, isolation_level=None)
+
+
+def iter_export(tables=tuple(COLUMNS)):
+    """Iterate the rows of the tables as flat records. The connection
+    is opened at once, the rows are read by cursors in one transaction."""
+    return iter_rows(connect(), tables)
+
+
+def iter_rows(connection, tables):
+    try:
+        connection.execute('BEGIN')
+        for table in tables:
+            columns = ('id',) + tuple(x for x in COLUMNS[table] if x not in HIDDEN)
+            sql = 'SELECT {0} FROM "{1}" ORDER BY id'
+            sql = sql.format(', '.join('"{0}"'.format(x) for x in columns), table)
+            for row in connection.execute(sql):
+                record = {'entity': table}
+                record.update(zip(columns, row))
+                yield record
+    finally:
+        connection.close()
+
+
+def export_catalog(file, tables=tuple(COLUMNS)):
+    """Write the flat records as NDJSON, return the count."""
+    count = 0
+    for count, x in enumerate(iter_export(tables), 1):
+        file.write(json.dumps(x, ensure_ascii=False) + '\n')
+    return count
+
+
+def open_file(filename, mode, compressed=False):
+    """Open the file as text, gzipped if it ends with .gz.
+    The filename - is the standard input or output."""
+    file = filename
+    if filename == '-':
+        file = sys.stdin.buffer if mode == 'r' else sys.stdout.buffer
+    if compressed or filename.endswith('.gz'):
+        return gzip.open(file, mode + 't', encoding='utf-8')
+    if filename == '-':
+        return io.TextIOWrapper(file, encoding='utf-8')
+    return open(file, mode, encoding='utf-8')
+
+
+def main():
+    parser = ArgumentParser(prog='python3 -m sni.bulk')
+    parser.add_argument('--db', default=rpc.cfg.get('sqlite', 'path', fallback=None))
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('import')
+    command.add_argument('filename')
+    command.add_argument('--chunk', type=int, default=10000)
+    command.add_argument('--gzip', action='store_true')
+    command = commands.add_parser('export')
+    command.add_argument('filename', nargs='?', default='-')
+    command.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+    if args.db is None or args.command is None:
+        parser.error('the database and the command are required')
+    db.bind_sqlite(args.db)
+    if args.command == 'import':
+        with open_file(args.filename, 'r', args.gzip) as lines:
+            report = rpc._import_catalog(iter_journals(lines), args.chunk)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        with open_file(args.filename, 'w', args.gzip) as file:
+            export_catalog(file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic, time
+
+try:
+    from fcntl import LOCK_EX, flock
+except ImportError:
+    flock = None
+
+
+class LRUCache:
+    """A bounded mapping with LRU eviction.
+    Entries older than the ttl are treated as missing."""
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def configure(self, size=None, ttl=None):
+        with self.lock:
+            self.size = size or self.size
+            self.ttl = ttl or self.ttl
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, stamp = self.data[key]
+                assert self.ttl is None or monotonic() - stamp <= self.ttl
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+                return default
+            except AssertionError:
+                del self.data[key]
+                self.misses += 1
+                return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value, monotonic()
+            self.data.move_to_end(key)
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size': len(self.data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'ratio': total and self.hits / total}
+
+
+class ResponseCache:
+    """Cache the encoded results of each method in its own LRU.
+    The keys hold the generations of the entities the results
+    depend on, so a change of them makes the old entries missed.
+    The generations are per process, a shared stamp file makes
+    a change in any other process miss all entries."""
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.sizes = {}
+        self.methods = {}
+        self.epoch = 0
+        self.generations = {}
+        self.shared = None
+        self.stamp = None
+        self.encode = json.dumps
+        self.lock = Lock()
+
+    def configure(self, size=None, ttl=None, **sizes):
+        """Set the default size and the sizes per method.
+        A size or a ttl of 0 disables the cache of the method,
+        without a ttl the entries live until the changes."""
+        with self.lock:
+            self.size = self.size if size is None else int(size)
+            self.ttl = self.ttl if ttl is None else ttl
+            self.sizes.update((k, int(v)) for k, v in sizes.items())
+            self.methods.clear()
+
+    def share(self, filename):
+        """Share the changes through the mtime of the file,
+        None keeps them in the process."""
+        with self.lock:
+            self.shared = filename
+            self.stamp = None
+            self.sync()
+
+    def sync(self):
+        """Bump the epoch if another process touched the stamp."""
+        if self.shared is None: return
+        try:
+            stamp = os.stat(self.shared).st_mtime_ns
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self.stamp:
+            self.epoch += 1
+            self.stamp = stamp
+
+    def touch(self):
+        """Move the stamp forward under a file lock, so the
+        changes of the other processes are never overwritten."""
+        with open(self.shared, 'a') as file:
+            if flock is not None: flock(file, LOCK_EX)
+            self.sync()
+            stamp = max(int(time() * 1e9), (self.stamp or 0) + 1)
+            os.utime(self.shared, ns=(stamp, stamp))
+            self.stamp = stamp
+
+    def cache(self, method):
+        with self.lock:
+            size = self.sizes.get(method, self.size)
+            if size and self.ttl != 0 and method not in self.methods:
+                self.methods[method] = LRUCache(size, self.ttl)
+            return self.methods.get(method)
+
+    def key(self, entities, args, kwargs):
+        """Normalize the arguments, the omitted ones are None."""
+        kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        with self.lock:
+            self.sync()
+            version = [self.epoch] + [self.generations.get(x, 0) for x in entities]
+        return json.dumps([args, kwargs, version], sort_keys=True)
+
+    def bump(self, *entities):
+        """Bump the generations, or all of them if none is given."""
+        with self.lock:
+            if not entities: self.epoch += 1
+            for x in entities: self.generations[x] = self.generations.get(x, 0) + 1
+            if self.shared is not None: self.touch()
+
+    def clear(self):
+        with self.lock:
+            for x in self.methods.values(): x.clear()
+
+    def stats(self):
+        with self.lock:
+            return {k: v.stats() for k, v in self.methods.items()}
@@ -1,8 +1,15 @@
 #!/usr/bin/env/python3
 # -*- coding: utf-8 -*-
+import os
+import sqlite3
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime
+from threading import local
+from time import sleep
+
 from pony import orm
-from sni import rpc
+from sni import rpc, search, timing, utils
 
 
 class EntityMeta(orm.core.EntityMeta):
@@ -19,6 +26,8 @@ class EntityMeta(orm.core.EntityMeta):
     def new(cls, *args, **kwargs):
         kwargs = cls.clean_kwargs(kwargs)
         result = cls(*args, **kwargs)
+        if getattr(state, 'batch', False):
+            return db.flush() or result
         return db.commit() or result
 
     @orm.db_session
@@ -35,13 +44,47 @@ class EntityMeta(orm.core.EntityMeta):
         return super().get(*args, **kwargs)
 
     @orm.db_session
-    def select(cls, **kwargs):
-        return cls.select_db(**kwargs)[:]
+    def select(cls, limit=None, after=None, **kwargs):
+        return utils.paginate(cls.select_db(**kwargs), limit, after)
 
     def select_db(cls, **kwargs):
         kwargs = cls.clean_kwargs(kwargs)
         return super().select().filter(**kwargs)
 
+    @orm.db_session
+    def select_rows(cls, limit=None, after=None, **kwargs):
+        """Select the dicts of to_dict without creating the entities.
+        The filters are validated and the rows paged as by select."""
+        paged = limit is not None or after is not None
+        limit = utils.Page.limit(limit)
+        where, params = ['"id" > $after'], {'after': after or 0, 'limit': limit + 1}
+        for i, (k, v) in enumerate(sorted(cls.clean_kwargs(kwargs).items())):
+            attr = cls._adict_.get(k)
+            if attr is None:
+                message = 'Entity {0} does not have attribute {1}'
+                raise AttributeError(message.format(cls.__name__, k))
+            v = attr.validate(v, None, cls, from_db=False)
+            where.append('"{0}" = $p{1}'.format(attr.column, i))
+            params['p{0}'.format(i)] = v.id if attr.reverse else attr.converters[0].py2sql(v)
+        attrs = cls._get_attrs_()
+        sql = 'SELECT {0} FROM "{1}" WHERE {2} ORDER BY "id" LIMIT $limit'
+        sql = sql.format(', '.join('"{0}"'.format(x.column) for x in attrs),
+                         cls._table_, ' AND '.join(where))
+        rows = db.select(sql, params)
+        with timing.Span('to_dict'):
+            keys = [x.name for x in attrs]
+            converters = [(i, x.converters[0].sql2py) for i, x in enumerate(attrs)
+                          if x.py_type is datetime]
+            items = []
+            for x in rows[:limit]:
+                if converters:
+                    x = list(x)
+                    for i, convert in converters:
+                        if x[i] is not None: x[i] = convert(x[i])
+                items.append(dict(zip(keys, x)))
+        next = items[-1]['id'] if len(rows) > limit else None
+        return utils.Page(items, next, paged)
+
     @staticmethod
     @orm.db_session
     def delete(self, **kwargs):
@@ -54,22 +97,274 @@ class EntityMeta(orm.core.EntityMeta):
         kwargs = EntityMeta.clean_kwargs(kwargs)
         self.set_db(**kwargs)
 
+    @staticmethod
+    def to_dict(self, *args, **kwargs):
+        if not timing.enabled:
+            return self.to_dict_db(*args, **kwargs)
+        with timing.Span('to_dict'):
+            return self.to_dict_db(*args, **kwargs)
+
 
 db = orm.Database()
+state = local()
 db.Entity.delete_db = db.Entity.delete
 db.Entity.set_db = db.Entity.set
+db.Entity.to_dict_db = db.Entity.to_dict
 db.Entity.delete = EntityMeta.delete
 db.Entity.set = EntityMeta.set
+db.Entity.to_dict = EntityMeta.to_dict
+
+
+@contextmanager
+def batch():
+    """Run the calls in one db_session with one commit.
+    New entities are only flushed inside the batch."""
+    state.batch = True
+    state.changes = []
+    try:
+        with orm.db_session:
+            yield
+    finally:
+        state.batch = False
+        for x in state.changes: utils.responses.bump(*x)
+
+
+@contextmanager
+def savepoint():
+    """Run a call of the batch in a savepoint. The rollback it yields
+    undoes the writes of the call, the earlier calls go on. Before the
+    first write there is no transaction, so the rollback is of the
+    db_session, whose changes are all flushed after each call."""
+    cache = db._get_cache()
+    if not cache.in_transaction:
+        yield orm.rollback
+        return
+    connection = cache.connection
+    connection.execute('SAVEPOINT call')
+    def rollback():
+        connection.execute('ROLLBACK TO call')
+        forget()
+    try:
+        yield rollback
+    finally:
+        if connection.in_transaction: connection.execute('RELEASE call')
+
+
+def forget():
+    """Replace the cache of the db_session, whose objects may hold
+    the rolled back writes, and keep its transaction."""
+    cache = db._get_cache()
+    connection = cache.connection
+    cache.connection, cache.in_transaction = None, False
+    cache.close(rollback=False)
+    cache = db._get_cache()
+    cache.connection, cache.in_transaction, cache.immediate = connection, True, True
+
+
+# durable: WAL with a fsync per commit, survives a power loss
+# fast: WAL with a fsync per checkpoint, a crash of the OS may
+# lose the last commits, but never corrupts the database
+PRESETS = {
+    'durable': {'journal_mode': 'wal', 'synchronous': 'full',
+                'cache_size': -16384, 'mmap_size': 0,
+                'temp_store': 'default', 'busy_timeout': 5000},
+    'fast': {'journal_mode': 'wal', 'synchronous': 'normal',
+             'cache_size': -65536, 'mmap_size': 268435456,
+             'temp_store': 'memory', 'busy_timeout': 5000},
+}
+pragmas = {}
+# the name the other connections open the database by
+location = None
+# the pristine database the resets copy from
+template = None
+# the pid and the directory of the template of the process
+template_dir = None, None
+# the read-only connections are opened if set
+readers = False
+
+
+@db.on_connect(provider='sqlite')
+def set_pragmas(database, connection):
+    cursor = connection.cursor()
+    for key, value in pragmas.items():
+        cursor.execute('PRAGMA {0} = {1}'.format(key, value))
+
+
+# the indexes that Pony can not declare, the partial
+# index only holds the open borrows of the overdue reports
+INDEXES = {
+    'idx_borrow__overdue': 'CREATE INDEX IF NOT EXISTS "{0}" '
+                           'ON "Borrow" ("agreedtime") WHERE "returntime" IS NULL',
+}
+
+
+@orm.db_session
+def create_indexes():
+    for name, sql in INDEXES.items():
+        db.execute(sql.format(name))
+
+
+@orm.db_session
+def create_counters():
+    """Rebuild the borrow counters of a database that had open borrows
+    before the counters were added, their tables are created empty."""
+    empty = not orm.exists(x for x in Quota) or not orm.exists(x for x in Lending)
+    if empty and orm.exists(x for x in Borrow if x.returntime is None):
+        rpc._check_borrow(repair=True)
 
 
-def bind_sqlite(filename=':memory:'):
+def bind_sqlite(filename=':memory:', preset=None, snapshot=None, **kwargs):
+    """Bind the database with the pragmas of the preset.
+    The [sqlite] options and the kwargs override them.
+    An in-memory database is restored from the snapshot."""
+    global location, readers, template
+    preset = preset or rpc.cfg.get('sqlite', 'preset', fallback='durable')
+    snapshot = snapshot or rpc.cfg.get('sqlite', 'snapshot', fallback='')
+    result = dict(PRESETS[preset])
+    result.update((k, rpc.cfg.get('sqlite', k)) for k in PRESETS[preset]
+                  if rpc.cfg.has_option('sqlite', k))
+    result.update(kwargs)
+    for key, value in result.items():
+        if key not in PRESETS[preset] or not str(value).lstrip('-').isalnum():
+            raise ValueError('Invalid pragma: {0} = {1}'.format(key, value))
+    pragmas.clear()
+    pragmas.update(result)
+    # the snapshot job copies it through its own connection
+    if snapshot and filename == ':memory:': filename = ':sharedmemory:'
     db.bind('sqlite', filename, create_db=True)
+    location = db.provider.pool.filename
+    # the template was copied from the database bound before
+    template = None
+    # a plain in-memory database is only seen by its own connection
+    readers = location != ':memory:' and rpc.cfg.getboolean('sqlite', 'readers', fallback=True)
+    # the other workers and the command line change a file database
+    memory = filename in (':memory:', ':sharedmemory:')
+    utils.responses.share(None if memory else location + '-cache')
+    if snapshot and filename == ':sharedmemory:' and os.path.exists(snapshot):
+        restore(snapshot)
     db.generate_mapping(create_tables=True)
+    create_indexes()
+    create_counters()
+    search.create_indexes()
     if not Admin.exists(username='A00000000'):
         rpc._admin_sign_up('A00000000', 'Admin', '12345678')
         rpc._guest_sign_up('G00000000', 'Guest', '12345678')
 
 
+def restore(filename):
+    """Copy the snapshot into the database before the mapping."""
+    source = sqlite3.connect(filename)
+    target = sqlite3.connect(location, uri=True)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+class Restarted(Exception):
+    pass
+
+
+def snapshot(filename, pages=1024, pause=0.001, restarts=3):
+    """Copy the database to the file with the online backup API,
+    the pages of a step are read in a short lock and the writers go
+    between the steps. A write of another connection restarts the copy,
+    after the restarts it is done in one step that holds the writers off.
+    The file is only replaced by a whole copy."""
+    temp = filename + '.tmp'
+    if os.path.exists(temp): os.remove(temp)
+    source = sqlite3.connect(location, uri=True)
+    target = sqlite3.connect(temp)
+    result = {'steps': 0, 'restarts': 0, 'remaining': None}
+    def progress(status, remaining, total):
+        result['steps'] += 1
+        # no page left is copied by a step that restarted
+        if not status and result['remaining'] is not None \
+                and remaining >= result['remaining']:
+            result['restarts'] += 1
+            if result['restarts'] > restarts: raise Restarted()
+        result['remaining'] = remaining
+        result['pages'] = total
+        sleep(pause)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress, sleep=pause)
+        except Restarted:
+            source.backup(target, sleep=pause)
+    finally:
+        source.close()
+        target.close()
+    os.replace(temp, filename)
+    del result['remaining']
+    result['size'] = os.path.getsize(filename)
+    return result
+
+
+def connection():
+    """The connection of the thread, used out of the db_session."""
+    connection, new = db.provider.connect()
+    if new: db.call_on_connect(connection)
+    return connection
+
+
+def connect_reader():
+    """Open a connection as Pony does and make it read-only."""
+    pool = db.provider.pool
+    reader = type(pool)(pool.is_shared_memory_db, pool.filename, pool.create_db, **pool.kwargs)
+    reader._connect()
+    db.call_on_connect(reader.con)
+    reader.con.execute('PRAGMA query_only = 1')
+    return os.getpid(), reader.con
+
+
+def read_only(function, *args, **kwargs):
+    """Call the function with its db_sessions on the read-only connection
+    of the thread, in place of the one the writes use. In a db_session,
+    e.g. of a batch, it stays on the connection of that. The swap is made
+    for one call, not a block, so that it can not be held across a yield
+    while the thread serves other requests."""
+    if not readers or orm.core.local.db_session is not None:
+        return function(*args, **kwargs)
+    pool = db.provider.pool
+    writer = pool.con, getattr(pool, 'pid', None)
+    connection = None
+    try:
+        pid, connection = getattr(state, 'reader', (None, None))
+        if pid != os.getpid(): pid, connection = state.reader = connect_reader()
+        pool.con, pool.pid = connection, pid
+        return function(*args, **kwargs)
+    finally:
+        # Pony closes the connection on some errors
+        if connection is not None and pool.con is not connection: state.reader = None, None
+        pool.con, pool.pid = writer
+
+
+def save_template():
+    """Copy the pristine database to a file for the resets.
+    The file of the process is replaced by the next save."""
+    global template, template_dir
+    if template_dir[0] != os.getpid():
+        template_dir = os.getpid(), tempfile.mkdtemp(prefix='sni-')
+    filename = os.path.join(template_dir[1], 'template.db')
+    if os.path.exists(filename): os.remove(filename)
+    target = sqlite3.connect(filename)
+    try:
+        connection().backup(target)
+    finally:
+        target.close()
+    template = filename
+
+
+def load_template(pause=0.001):
+    """Copy the pristine database over the bound one."""
+    source = sqlite3.connect(template)
+    try:
+        source.backup(connection(), sleep=pause)
+    finally:
+        source.close()
+
+
 class User(db.Entity, metaclass=EntityMeta):
     username = orm.Required(str, unique=True)
     nickname = orm.Required(str)
@@ -87,7 +382,7 @@ class Guest(User): pass
 
 class Session(db.Entity, metaclass=EntityMeta):
     sessionid = orm.Required(str, unique=True)
-    shelflife = orm.Required(datetime)
+    shelflife = orm.Required(datetime, index=True)
     user      = orm.Required('User')
 
 
@@ -134,11 +429,9 @@ class Article(db.Entity, metaclass=EntityMeta):
 
     @property
     def keywords(self):
-        return self.keyword1 + '\n' + \
-               self.keyword2 + '\n' + \
-               self.keyword3 + '\n' + \
-               self.keyword4 + '\n' + \
-               self.keyword5
+        keywords = (self.keyword1, self.keyword2, self.keyword3,
+                    self.keyword4, self.keyword5)
+        return '\n'.join(x for x in keywords if x)
 
 
 class Borrow(db.Entity, metaclass=EntityMeta):
@@ -147,3 +440,15 @@ class Borrow(db.Entity, metaclass=EntityMeta):
     returntime = orm.Optional(datetime)
     user       = orm.Required('User')
     storage    = orm.Required('Storage')
+
+
+# the counters of the open borrows, which are
+# kept in the transactions changing the borrows
+class Quota(db.Entity, metaclass=EntityMeta):
+    user   = orm.PrimaryKey(int)
+    opened = orm.Required(int)
+
+
+class Lending(db.Entity, metaclass=EntityMeta):
+    storage = orm.PrimaryKey(int)
+    borrow  = orm.Optional(int)
@@ -0,0 +1,92 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter, time
+
+from sni import metrics
+
+
+class Job:
+    """A function run every interval seconds.
+    The result of the last run is kept for the stats."""
+    def __init__(self, name, interval, function):
+        self.name = name
+        self.interval = interval
+        self.function = function
+        self.due = monotonic() + interval
+        self.runs = 0
+        self.errors = 0
+        self.last = None
+        self.elapsed = 0.0
+        self.result = None
+
+    def run(self):
+        start = perf_counter()
+        try:
+            self.result = self.function()
+        except Exception:
+            self.errors += 1
+            metrics.logger.exception('The job %s failed.', self.name)
+        finally:
+            self.runs += 1
+            self.last = time()
+            self.elapsed = perf_counter() - start
+            self.due = monotonic() + self.interval
+
+    def stats(self):
+        return {'interval': self.interval, 'runs': self.runs,
+                'errors': self.errors, 'last': self.last,
+                'elapsed': round(self.elapsed, 6), 'result': self.result}
+
+
+class Scheduler:
+    """Run the due jobs one by one in a daemon thread.
+    A job with an interval of 0 is never run."""
+    def __init__(self):
+        self.jobs = {}
+        self.lock = Lock()
+        self.event = Event()
+        self.thread = None
+
+    def add(self, name, interval, function):
+        with self.lock:
+            if interval > 0: self.jobs[name] = Job(name, interval, function)
+            else: self.jobs.pop(name, None)
+
+    def run_pending(self):
+        """Run the due jobs and return the seconds to the next."""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for x in jobs:
+            if x.due <= monotonic(): x.run()
+        dues = [x.due for x in jobs]
+        return max(min(dues) - monotonic(), 0) if dues else 60.0
+
+    def run(self, name):
+        with self.lock:
+            job = self.jobs[name]
+        job.run()
+        return job.result
+
+    def loop(self):
+        while not self.event.wait(self.run_pending()):
+            pass
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.event.clear()
+            self.thread = Thread(target=self.loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.event.set()
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+
+    def stats(self):
+        with self.lock:
+            return {k: v.stats() for k, v in self.jobs.items()}
+
+
+scheduler = Scheduler()
@@ -0,0 +1,161 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+import json
+import logging
+import random
+import sys
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import partial, wraps
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from threading import Lock
+from time import perf_counter, time
+
+from sni import utils
+
+# upper bounds of the latency buckets in seconds, from 50us to 5min
+BOUNDS = [0.00005 * 1.25 ** i for i in range(71)]
+CODES = (400, 401, 403, 409, 412, 500, 503)
+logger = logging.getLogger('sni')
+
+
+class Histogram:
+    """Count the latencies in exponential buckets.
+    A quantile is the upper bound of its bucket."""
+    def __init__(self):
+        self.counts = [0] * len(BOUNDS)
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[min(bisect_left(BOUNDS, value), len(BOUNDS) - 1)] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, q):
+        seen = 0
+        for bound, count in zip(BOUNDS, self.counts):
+            seen += count
+            if seen >= q * self.total and seen: return round(bound, 6)
+
+    def stats(self):
+        return {'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99),
+                'mean': round(self.sum / self.total, 6) if self.total else None}
+
+
+class Method:
+    def __init__(self):
+        self.calls = 0
+        self.inflight = 0
+        self.errors = dict.fromkeys(CODES, 0)
+        self.latency = Histogram()
+
+    def stats(self):
+        return dict(calls=self.calls,
+                    inflight=self.inflight,
+                    errors=dict(self.errors),
+                    **self.latency.stats())
+
+
+class Registry:
+    """Collect the counters, latencies and errors per method.
+    Other stats are read from the gauges on each snapshot."""
+    def __init__(self, sample=0.01):
+        self.sample = sample
+        self.lock = Lock()
+        self.gauges = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.requests = Method()
+
+    def begin(self, name=None):
+        with self.lock:
+            method = self.requests if name is None else \
+                self.methods.setdefault(name, Method())
+            method.inflight += 1
+        return perf_counter()
+
+    def end(self, name, start, code=None):
+        elapsed = perf_counter() - start
+        with self.lock:
+            method = self.requests if name is None else self.methods[name]
+            method.inflight -= 1
+            method.calls += 1
+            method.latency.add(elapsed)
+            if code is not None:
+                method.errors[code] = method.errors.get(code, 0) + 1
+        if name is not None and (code == 500 or random.random() < self.sample):
+            self.log(name, elapsed, code)
+        return elapsed
+
+    @contextmanager
+    def request(self):
+        """Count a request of the HTTP server."""
+        start = self.begin()
+        try:
+            yield
+        finally:
+            self.end(None, start)
+
+    def track(self, name, function):
+        """Wrap the method to count its calls.
+        The Fault raised is counted by its code.
+        A streamed result is counted once it is sent."""
+        @wraps(function)
+        def _track(*args, **kwargs):
+            start = self.begin(name)
+            code = result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            except utils.Fault as e:
+                code = e.error.code
+                raise
+            except Exception:
+                code = 500
+                raise
+            finally:
+                if isinstance(result, utils.Stream):
+                    result.hooks.append(partial(self.end, name, start))
+                else:
+                    self.end(name, start, code)
+        return _track
+
+    def instrument(self, dispatcher):
+        for name, function in list(dispatcher.items()):
+            dispatcher[name] = self.track(name, function)
+
+    @staticmethod
+    def log(name, elapsed, code):
+        record = {'time': round(time(), 3), 'method': name,
+                  'elapsed': round(elapsed, 6), 'code': code}
+        logger.info(json.dumps(record))
+
+    def snapshot(self):
+        with self.lock:
+            result = {'requests': self.requests.stats(),
+                      'methods': {k: v.stats() for k, v in self.methods.items()}}
+        for name, gauge in self.gauges.items():
+            result[name] = gauge()
+        return result
+
+
+registry = Registry()
+
+
+def start_logging(stream=sys.stderr):
+    """Write the log records from a background thread,
+    so that a slow stream never blocks the requests."""
+    queue = Queue()
+    logger.addHandler(QueueHandler(queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener = QueueListener(queue, logging.StreamHandler(stream))
+    listener.start()
+    return listener
@@ -0,0 +1,98 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+import os
+import signal
+import sys
+import traceback
+from time import monotonic, sleep
+
+
+class Stop(Exception):
+    pass
+
+
+def run_child(target, *args):
+    """Run the target in a forked process and exit."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        target(*args)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def run_once(target, *args):
+    """Run the target in a child process and wait for it,
+    so that the parent never opens the database itself."""
+    pid = os.fork()
+    if pid == 0: run_child(target, *args)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError('The child exited with {0}.'.format(status))
+
+
+class Supervisor:
+    """Fork the workers and restart the ones that exit.
+    The target gets the index of its worker first, which a
+    restarted worker keeps. On SIGTERM or SIGINT the workers get SIGINT to finish
+    their requests, and SIGKILL after the timeout."""
+    def __init__(self, workers, target, *args, timeout=10.0):
+        self.workers = workers
+        self.target = target
+        self.args = args
+        self.timeout = timeout
+        self.children = {}
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0: run_child(self.target, index, *self.args)
+        self.children[pid] = index, monotonic()
+
+    @staticmethod
+    def stop_handler(signum, frame):
+        raise Stop()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop_handler)
+        signal.signal(signal.SIGINT, self.stop_handler)
+        try:
+            for index in range(self.workers): self.spawn(index)
+            while True:
+                pid, status = os.wait()
+                child = self.children.pop(pid, None)
+                if child is None: continue
+                print('Worker {0} exited with {1}.'.format(pid, status))
+                # avoid a busy loop if the workers crash at once
+                if monotonic() - child[1] < 1: sleep(1)
+                self.spawn(child[0])
+        except Stop:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for pid in self.children: self.kill(pid, signal.SIGINT)
+        deadline = monotonic() + self.timeout
+        while self.children and monotonic() < deadline:
+            for pid in list(self.children):
+                if os.waitpid(pid, os.WNOHANG)[0]: del self.children[pid]
+            sleep(0.05)
+        for pid in self.children:
+            self.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.clear()
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -1,16 +1,38 @@
 #!/usr/bin/env/python3
 # -*- coding: utf-8 -*-
 from configparser import ConfigParser
+from datetime import datetime
 
 from jsonrpc import Dispatcher
 from pony import orm
 
-from sni import db, utils
+from sni import bulk, db, metrics, search, timing, utils
 from sni.utils import Fault
 
 d = Dispatcher()
 cfg = ConfigParser()
 cfg.read('../settings.ini')
+utils.Page.size = cfg.getint('page', 'size', fallback=1000)
+utils.sessions.configure(cfg.getint('session', 'cache_size', fallback=None),
+                         cfg.getfloat('session', 'cache_ttl', fallback=None))
+utils.hasher.configure(cfg.getint('bcrypt', 'rounds', fallback=None),
+                       cfg.getint('bcrypt', 'workers', fallback=None),
+                       cfg.getint('bcrypt', 'queue', fallback=None),
+                       cfg.get('bcrypt', 'pool', fallback=None))
+metrics.registry.sample = cfg.getfloat('log', 'sample', fallback=0.01)
+timing.enabled = cfg.getboolean('profile', 'enabled', fallback=False)
+if cfg.has_section('cache'):
+    utils.responses.configure(**{k: cfg.getfloat('cache', k) for k in cfg.options('cache')})
+borrow_limit = cfg.getint('borrow', 'limit', fallback=5)
+utils.admission.retry = cfg.getfloat('admission', 'retry', fallback=1.0)
+for x in utils.Admission.CLASSES:
+    utils.admission.configure(x, cfg.getint('admission', x, fallback=0),
+                              cfg.getint('admission', x + '_queue', fallback=0),
+                              cfg.getfloat('admission', 'wait', fallback=1.0))
+# the fine per day after the grace days, a cap of 0 is no cap
+fine = {'daily': cfg.getfloat('fine', 'daily', fallback=0.1),
+        'grace': cfg.getint('fine', 'grace', fallback=0),
+        'cap': cfg.getfloat('fine', 'cap', fallback=0.0) or float('inf')}
 
 check_issn = utils.check_regex(r'^\d{4}-\d{3}[0-9X]$')
 check_isbn = utils.check_regex(r'^CN\d{2}-\d{4}$')
@@ -23,12 +45,67 @@ def restart_world():
     return _restart_world()
 
 
+@utils.changes()
 def _restart_world():
-    """Drop all tables and recreate them."""
+    """Copy the pristine database over the bound one, which is
+    made the first time by dropping and recreating all tables.
+    The copy would bypass an open transaction, so it is refused."""
+    if orm.core.local.db_session is not None or getattr(db.state, 'batch', False):
+        message = 'Restart inside a transaction.'
+        raise Fault(409, message)
+    utils.sessions.clear()
+    utils.responses.clear()
+    if db.template is not None: return db.load_template()
+    search.drop_indexes()
     db.db.drop_all_tables(with_all_data=True)
     db.db.create_tables(check_tables=True)
+    db.create_indexes()
+    search.create_indexes()
     _admin_sign_up('A00000000', 'Admin', '12345678')
     _guest_sign_up('G00000000', 'Guest', '12345678')
+    db.save_template()
+
+
+@d.add_method
+@utils.catch_error
+@utils.check_admin
+def rebuild_index():
+    return _rebuild_index()
+
+
+def _rebuild_index():
+    """Rebuild the full-text and trigram indexes."""
+    search.rebuild_indexes()
+
+
+@d.add_method
+@utils.catch_error
+@utils.check_admin
+def import_catalog(*args, **kwargs):
+    return _import_catalog(*args, **kwargs)
+
+
+@utils.changes()
+def _import_catalog(journals, chunk=10000):
+    """Import the nested journals in chunked transactions.
+    Invalid records are skipped and reported."""
+    return bulk.import_catalog(journals, chunk)
+
+
+@d.add_method
+@utils.catch_error
+@utils.check_admin
+def export_catalog():
+    return _export_catalog()
+
+
+def _export_catalog():
+    """Stream all the rows as flat records in one transaction.
+    The result can be imported again."""
+    try:
+        return utils.Stream(bulk.iter_export())
+    except ValueError as e:
+        raise Fault(409, str(e))
 
 
 @d.add_method
@@ -103,6 +180,8 @@ def _sign_in(username, password):
         assert db.User.exists(username=username)
         user = db.User.get(username=username)
         assert utils.check_pw(password, user.password)
+        if utils.needs_rehash(user.password):
+            user.password = utils.hash_pw(password)
         session = utils.update_session(user)
         return session.sessionid
     except AssertionError:
@@ -119,12 +198,14 @@ def sign_out(*args, **kwargs):
 @orm.db_session
 @utils.check_session
 def _sign_out(session):
+    utils.sessions.pop(session)
     session = db.Session.get(sessionid=session)
     session.shelflife = utils.new_shelflife(0)
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 def get_user(*args, **kwargs):
     return _get_user(*args, **kwargs)
 
@@ -132,13 +213,18 @@ def get_user(*args, **kwargs):
 @orm.db_session
 @utils.check_session
 def _get_user(session):
-    session = db.Session.get(sessionid=session)
-    return session.user.to_dict()
+    found = db.Session.get(sessionid=session)
+    # reaped since it was cached, as on a miss
+    if found is None: utils.sessions.pop(session)
+    assert found is not None
+    return found.user.to_dict()
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.paged
 def get_user_advanced(*args, **kwargs):
     return _get_user_advanced(*args, **kwargs)
 
@@ -150,11 +236,28 @@ def _get_user_advanced(id=None,
                        forename=None,
                        lastname=None,
                        mailaddr=None,
-                       phonenum=None):
+                       phonenum=None,
+                       limit=None,
+                       after=None):
     users = db.User.select(**locals())
-    users = [x.to_dict() for x in users]
-    for x in users: x['password'] = str()
-    return users
+    return users.map(_user_converter(users))
+
+
+def _user_converter(users):
+    """Get the function to convert the users to dicts.
+    Their sessions are fetched in one query instead of
+    one for each user, and their passwords are hidden."""
+    ids = [x.id for x in users]
+    query = orm.select((x.user.id, x.id) for x in db.Session if x.user.id in ids)
+    sessions = dict(query[:]) if ids else {}
+    def _convert(user):
+        result = user.to_dict(exclude='session')
+        classtype = result.pop('classtype')
+        result['password'] = str()
+        result['session'] = sessions.get(user.id)
+        result['classtype'] = classtype
+        return result
+    return _convert
 
 
 @d.add_method
@@ -187,10 +290,22 @@ def del_user(*args, **kwargs):
 @orm.db_session
 @utils.check_session
 def _del_user(session):
+    utils.sessions.pop(session)
     session = db.Session.get(sessionid=session)
     session.user.delete()
 
 
+def _prefetch(results, key, entity, converter=None):
+    """Replace the ids under the key with the dicts.
+    All of them are fetched in one query and shared."""
+    ids = list({x[key] for x in results})
+    objects = entity.select_db().filter(lambda x: x.id in ids)[:] if ids else []
+    convert = converter(objects) if converter else lambda x: x.to_dict()
+    objects = {x.id: convert(x) for x in objects}
+    for x in results: x[key] = objects[x[key]]
+    return list(objects.values())
+
+
 @d.add_method
 @utils.catch_error
 @utils.check_admin
@@ -198,6 +313,7 @@ def add_journal(*args, **kwargs):
     return _add_journal(*args, **kwargs)
 
 
+@utils.changes('Journal')
 @orm.db_session
 def _add_journal(name, issn,
                  isbn, post,
@@ -217,7 +333,10 @@ def _add_journal(name, issn,
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.cached('Journal')
+@utils.paged
 def get_journal(*args, **kwargs):
     return _get_journal(*args, **kwargs)
 
@@ -228,20 +347,23 @@ def _get_journal(id=None,
                  isbn=None, post=None,
                  host=None, addr=None,
                  freq=None, lang=None,
-                 hist=None, used=None):
-    journals = db.Journal.select(**locals())
-    return [x.to_dict() for x in journals]
+                 hist=None, used=None,
+                 limit=None, after=None):
+    return db.Journal.select_rows(**locals())
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.paged
 def get_journal_advanced(id=None,
                          name=None, issn=None,
                          isbn=None, post=None,
                          host=None, addr=None,
                          freq=None, lang=None,
-                         hist=None, used=None):
+                         hist=None, used=None,
+                         limit=None, after=None):
     return _get_journal_advanced(**locals())
 
 
@@ -249,17 +371,37 @@ def get_journal_advanced(id=None,
 def _get_journal_advanced(name=None,
                           addr=None,
                           used=None,
+                          limit=None,
+                          after=None,
                           **kwargs):
+    """Filter the journals by substrings.
+    The page is matched in SQL with the trigram index, by id."""
+    if not search.journals.available:
+        return _scan_journal_advanced(name, addr, used, limit, after, **kwargs)
+    terms = (('name', name), ('addr', addr), ('used', used))
+    terms = [((k,), v) for k, v in terms if v]
+    kwargs = db.EntityMeta.clean_kwargs(kwargs)
+    ids = search.journals.search(terms, kwargs, utils.Page.limit(limit), after, ranked=False)
+    ids.paged = limit is not None or after is not None
+    results = db.Journal.select_db().filter(lambda x: x.id in ids)
+    results = {x.id: x for x in results}
+    return ids.map(lambda x: results[x].to_dict())
+
+
+def _scan_journal_advanced(name, addr, used, limit, after, **kwargs):
     journals = db.Journal.select_db(**kwargs)
     if name: journals = journals.filter(lambda x: name in x.name)
     if addr: journals = journals.filter(lambda x: addr in x.addr)
     if used: journals = journals.filter(lambda x: used in x.used)
-    return [x.to_dict() for x in list(journals)]
+    journals = utils.paginate(journals, limit, after)
+    return journals.map(lambda x: x.to_dict())
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.cached('Journal', 'Subscribe', 'Storage', 'Borrow')
 def get_journal_reverse(*args, **kwargs):
     return _get_journal_reverse(*args, **kwargs)
 
@@ -285,6 +427,7 @@ def set_journal(*args, **kwargs):
     return _set_journal(*args, **kwargs)
 
 
+@utils.changes('Journal')
 @orm.db_session
 def _set_journal(id,
                  name=None, issn=None,
@@ -309,6 +452,7 @@ def del_journal(*args, **kwargs):
     return _del_journal(*args, **kwargs)
 
 
+@utils.changes('Journal')
 @orm.db_session
 def _del_journal(id):
     db.Journal[id].delete()
@@ -321,6 +465,7 @@ def add_subscribe(*args, **kwargs):
     return _add_subscribe(*args, **kwargs)
 
 
+@utils.changes('Subscribe')
 @orm.db_session
 def _add_subscribe(year, journal):
     journal = journal and db.Journal[journal]
@@ -329,7 +474,10 @@ def _add_subscribe(year, journal):
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.cached('Journal', 'Subscribe')
+@utils.paged
 def get_subscribe(*args, **kwargs):
     return _get_subscribe(*args, **kwargs)
 
@@ -337,15 +485,19 @@ def get_subscribe(*args, **kwargs):
 @orm.db_session
 def _get_subscribe(id=None,
                    year=None,
-                   journal=None):
+                   journal=None,
+                   limit=None,
+                   after=None):
     journal = journal and db.Journal[journal]
-    subscribe = db.Subscribe.select(**locals())
-    return [x.to_dict() for x in subscribe]
+    return db.Subscribe.select_rows(**locals())
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.cached('Journal', 'Subscribe')
+@utils.paged
 def get_subscribe_full(*args, **kwargs):
     return _get_subscribe_full(*args, **kwargs)
 
@@ -353,9 +505,11 @@ def get_subscribe_full(*args, **kwargs):
 @orm.db_session
 def _get_subscribe_full(id=None,
                         year=None,
-                        journal=None):
-    results = _get_subscribe(id=id, year=year, journal=journal)
-    for x in results: x['journal'] = _get_journal(x['journal'])[0]
+                        journal=None,
+                        limit=None,
+                        after=None):
+    results = _get_subscribe(**locals())
+    _prefetch(results, 'journal', db.Journal)
     return results
 
 
@@ -366,6 +520,7 @@ def set_subscribe(*args, **kwargs):
     return _set_subscribe(*args, **kwargs)
 
 
+@utils.changes('Subscribe')
 @orm.db_session
 def _set_subscribe(id,
                    year=None,
@@ -381,6 +536,7 @@ def del_subscribe(*args, **kwargs):
     return _del_subscribe(*args, **kwargs)
 
 
+@utils.changes('Subscribe')
 @orm.db_session
 def _del_subscribe(id):
     db.Subscribe[id].delete()
@@ -393,6 +549,7 @@ def add_storage(*args, **kwargs):
     return _add_storage(*args, **kwargs)
 
 
+@utils.changes('Storage')
 @orm.db_session
 def _add_storage(volume,
                  number,
@@ -403,7 +560,10 @@ def _add_storage(volume,
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.cached('Subscribe', 'Storage')
+@utils.paged
 def get_storage(*args, **kwargs):
     return _get_storage(*args, **kwargs)
 
@@ -412,15 +572,19 @@ def get_storage(*args, **kwargs):
 def _get_storage(id=None,
                  volume=None,
                  number=None,
-                 subscribe=None):
+                 subscribe=None,
+                 limit=None,
+                 after=None):
     subscribe = db.Subscribe[subscribe]
-    storage = db.Storage.select(**locals())
-    return [x.to_dict() for x in storage]
+    return db.Storage.select_rows(**locals())
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.cached('Journal', 'Subscribe', 'Storage')
+@utils.paged
 def get_storage_full(*args, **kwargs):
     return _get_storage_full(*args, **kwargs)
 
@@ -429,14 +593,18 @@ def get_storage_full(*args, **kwargs):
 def _get_storage_full(id=None,
                       volume=None,
                       number=None,
-                      subscribe=None):
-    results = _get_storage(id=id, volume=volume, number=number, subscribe=subscribe)
-    for x in results: x['subscribe'] = _get_subscribe_full(x['subscribe'])[0]
+                      subscribe=None,
+                      limit=None,
+                      after=None):
+    results = _get_storage(**locals())
+    subscribe = _prefetch(results, 'subscribe', db.Subscribe)
+    _prefetch(subscribe, 'journal', db.Journal)
     return results
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
 def is_borrowed(*args, **kwargs):
     return _is_borrowed(*args, **kwargs)
@@ -444,7 +612,8 @@ def is_borrowed(*args, **kwargs):
 
 @orm.db_session
 def _is_borrowed(id):
-    return db.Borrow.exists_db(storage=id, returntime=None)
+    lending = db.Lending.get(storage=id)
+    return lending is not None and lending.borrow is not None
 
 
 @d.add_method
@@ -454,6 +623,7 @@ def set_storage(*args, **kwargs):
     return _set_storage(*args, **kwargs)
 
 
+@utils.changes('Storage')
 @orm.db_session
 def _set_storage(id,
                  volume=None,
@@ -470,6 +640,7 @@ def del_storage(*args, **kwargs):
     return _del_storage(*args, **kwargs)
 
 
+@utils.changes('Storage')
 @orm.db_session
 def _del_storage(id):
     db.Storage[id].delete()
@@ -482,6 +653,7 @@ def add_article(*args, **kwargs):
     return _add_article(*args, **kwargs)
 
 
+@utils.changes('Article')
 @orm.db_session
 def _add_article(title,
                  author,
@@ -498,7 +670,10 @@ def _add_article(title,
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.cached('Storage', 'Article')
+@utils.paged
 def get_article(*args, **kwargs):
     return _get_article(*args, **kwargs)
 
@@ -513,21 +688,26 @@ def _get_article(id=None,
                  keyword2=None,
                  keyword3=None,
                  keyword4=None,
-                 keyword5=None):
+                 keyword5=None,
+                 limit=None,
+                 after=None):
     storage = storage and db.Storage[storage]
-    articles = db.Article.select(**locals())
-    return [x.to_dict() for x in articles]
+    return db.Article.select_rows(**locals())
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.paged
 def get_article_advanced(id=None,
                          title=None,
                          author=None,
                          pagenum=None,
                          storage=None,
-                         keywords=None):
+                         keywords=None,
+                         limit=None,
+                         after=None):
     return _get_article_advanced(**locals())
 
 
@@ -535,13 +715,37 @@ def get_article_advanced(id=None,
 def _get_article_advanced(title=None,
                           author=None,
                           keywords=None,
+                          limit=None,
+                          after=None,
                           **kwargs):
+    """Search the articles with the full-text index.
+    The results are ranked by BM25 if the index is used."""
+    if not search.articles.available:
+        return _scan_article_advanced(title, author, keywords, limit, after, **kwargs)
+    terms = [(('title',), title)] if title else []
+    terms += [(('author',), author)] if author else []
+    keywords = keywords.split() if keywords is not None else tuple()
+    terms += [(search.articles.columns[2:], k) for k in keywords]
+    kwargs = db.EntityMeta.clean_kwargs(kwargs)
+    ids = search.articles.search(terms, kwargs, utils.Page.limit(limit), after)
+    ids.paged = limit is not None or after is not None
+    results = db.Article.select_db().filter(lambda x: x.id in ids)
+    results = {x.id: x for x in results}
+    return ids.map(lambda x: results[x].to_dict())
+
+
+def _scan_article_advanced(title, author, keywords, limit, after, **kwargs):
     results = db.Article.select_db(**kwargs)
     if title: results = results.filter(lambda x: title in x.title)
     if author: results = results.filter(lambda x: author in x.author)
     keywords = keywords.split() if keywords is not None else tuple()
-    for k in keywords: results = results.filter(lambda x: k in x.keywords)
-    return [x.to_dict() for x in list(results)]
+    for k in keywords: results = results.filter(lambda x: k in x.keyword1 or
+                                                          k in x.keyword2 or
+                                                          k in x.keyword3 or
+                                                          k in x.keyword4 or
+                                                          k in x.keyword5)
+    results = utils.paginate(results, limit, after)
+    return results.map(lambda x: x.to_dict())
 
 
 @d.add_method
@@ -551,6 +755,7 @@ def set_article(*args, **kwargs):
     return _set_article(*args, **kwargs)
 
 
+@utils.changes('Article')
 @orm.db_session
 def _set_article(id,
                  title=None,
@@ -573,6 +778,7 @@ def del_article(*args, **kwargs):
     return _del_article(*args, **kwargs)
 
 
+@utils.changes('Article')
 @orm.db_session
 def _del_article(id):
     db.Article[id].delete()
@@ -585,6 +791,7 @@ def add_borrow(*args, **kwargs):
     return _add_borrow(*args, **kwargs)
 
 
+@utils.changes('Borrow')
 @orm.db_session
 def _add_borrow(user,
                 storage,
@@ -599,7 +806,9 @@ def _add_borrow(user,
         borrowtime = utils.new_borrowtime(borrowtime)
         agreedtime = utils.new_agreedtime(agreedtime)
         returntime = utils.new_returntime(returntime)
-        return db.Borrow.new(**locals()).id
+        borrow = db.Borrow(**locals())
+        _count_borrow(db.db.flush() or borrow, 1)
+        return borrow.id
     except AssertionError as e:
         message = 'Already {0}.'
         raise Fault(409, message, e)
@@ -607,7 +816,9 @@ def _add_borrow(user,
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.paged
 def get_borrow(*args, **kwargs):
     return _get_borrow(*args, **kwargs)
 
@@ -618,16 +829,19 @@ def _get_borrow(id=None,
                 storage=None,
                 borrowtime=None,
                 agreedtime=None,
-                returntime=None):
+                returntime=None,
+                limit=None,
+                after=None):
     user = db.User[user]
     storage = db.Storage[storage]
-    borrows = db.Borrow.select(**locals())
-    return [x.to_dict() for x in borrows]
+    return db.Borrow.select_rows(**locals())
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
+@utils.paged
 def get_borrow_full(*args, **kwargs):
     return _get_borrow_full(*args, **kwargs)
 
@@ -638,15 +852,20 @@ def _get_borrow_full(id=None,
                      storage=None,
                      borrowtime=None,
                      agreedtime=None,
-                     returntime=None):
+                     returntime=None,
+                     limit=None,
+                     after=None):
     results = _get_borrow(**locals())
-    for x in results: x['user'] = _get_user_advanced(x['user'])[0]
-    for x in results: x['storage'] = _get_storage_full(x['storage'])[0]
+    _prefetch(results, 'user', db.User, _user_converter)
+    storage = _prefetch(results, 'storage', db.Storage)
+    subscribe = _prefetch(storage, 'subscribe', db.Subscribe)
+    _prefetch(subscribe, 'journal', db.Journal)
     return results
 
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
 def is_returned(*args, **kwargs):
     return _is_returned(*args, **kwargs)
@@ -659,6 +878,7 @@ def _is_returned(id):
 
 @d.add_method
 @utils.catch_error
+@utils.reads
 @utils.check_user
 def is_abused(*args, **kwargs):
     return _is_abused(*args, **kwargs)
@@ -666,8 +886,73 @@ def is_abused(*args, **kwargs):
 
 @orm.db_session
 def _is_abused(user):
-    results = db.Borrow.select_db(user=user, returntime=None)
-    return results.count() > int(cfg['borrow']['limit'])
+    quota = db.Quota.get(user=user)
+    return quota is not None and quota.opened > borrow_limit
+
+
+def _count_borrow(borrow, delta):
+    """Add the borrow to the counters if it is open,
+    or remove it from them if the delta is negative."""
+    if borrow.returntime is not None: return
+    user, storage = borrow.user.id, borrow.storage.id
+    quota = db.Quota.get(user=user) or db.Quota(user=user, opened=0)
+    lending = db.Lending.get(storage=storage) or db.Lending(storage=storage)
+    if delta > 0 and lending.borrow is not None:
+        message = 'Already {0}.'
+        raise Fault(409, message, 'borrowed')
+    quota.opened += delta
+    lending.borrow = borrow.id if delta > 0 else None
+
+
+# the days and the fines of the borrows open and due before $now,
+# all of them are computed in one pass over the partial index
+OVERDUE = '''SELECT id, user, storage, agreedtime, days,
+    ROUND(MIN(MAX(days - $grace, 0) * $daily, $cap), 2) AS fine
+    FROM (SELECT id, user, storage, agreedtime,
+          CAST(julianday($now) - julianday(agreedtime) AS INTEGER) AS days
+          FROM Borrow INDEXED BY idx_borrow__overdue
+          WHERE returntime IS NULL AND agreedtime < $now)'''
+
+
+@d.add_method
+@utils.catch_error
+@utils.reads
+@utils.check_admin
+@utils.paged
+def get_overdue(*args, **kwargs):
+    return _get_overdue(*args, **kwargs)
+
+
+@orm.db_session
+def _get_overdue(now=None, group=False, limit=None, after=None):
+    """Get the page of the overdue borrows with their fines,
+    or of their users with the sums if grouped."""
+    paged = limit is not None or after is not None
+    limit = utils.Page.limit(limit)
+    if group:
+        keys = 'user', 'count', 'days', 'fine'
+        sql = 'SELECT user, COUNT(*), MAX(days), ROUND(TOTAL(fine), 2) ' \
+              'FROM ({0}) WHERE user > $after GROUP BY user ORDER BY user LIMIT $limit'
+    else:
+        keys = 'id', 'user', 'storage', 'agreedtime', 'days', 'fine'
+        sql = 'SELECT * FROM ({0}) WHERE id > $after ORDER BY id LIMIT $limit'
+    now = str(utils.new_returntime(now) or datetime.now())
+    params = dict(fine, now=now, after=after or 0, limit=limit + 1)
+    items = [dict(zip(keys, x)) for x in db.db.select(sql.format(OVERDUE), params)]
+    convert = db.Borrow.agreedtime.converters[0].sql2py
+    for x in items:
+        if 'agreedtime' in x: x['agreedtime'] = convert(x['agreedtime'])
+    next = items[limit - 1][keys[0]] if len(items) > limit else None
+    return utils.Page(items[:limit], next, paged)
+
+
+@orm.db_session
+def _count_overdue(now=None):
+    """Summarize the overdue borrows for the scheduled job."""
+    sql = 'SELECT COUNT(*), COUNT(DISTINCT user), ROUND(TOTAL(fine), 2) FROM ({0})'
+    now = str(utils.new_returntime(now) or datetime.now())
+    result = db.db.select(sql.format(OVERDUE), dict(fine, now=now))[0]
+    return dict(zip(('borrows', 'users', 'fine'), result))
 
 
 @d.add_method
@@ -677,6 +962,7 @@ def set_borrow(*args, **kwargs):
     return _set_borrow(*args, **kwargs)
 
 
+@utils.changes('Borrow')
 @orm.db_session
 def _set_borrow(id=None,
                 user=None,
@@ -689,7 +975,11 @@ def _set_borrow(id=None,
     borrowtime = utils.new_borrowtime(borrowtime)
     agreedtime = utils.new_agreedtime(agreedtime)
     returntime = utils.new_returntime(returntime)
-    db.Borrow[id].set(**locals())
+    kwargs = locals()
+    borrow = db.Borrow[id]
+    _count_borrow(borrow, -1)
+    borrow.set(**kwargs)
+    _count_borrow(borrow, 1)
 
 
 @d.add_method
@@ -703,8 +993,9 @@ def end_borrow(*args, **kwargs):
 def _end_borrow(id):
     try:
         assert not _is_returned(id)
-        returntime = utils.new_borrowtime()
-        db.Borrow[id].set(**locals())
+        borrow = db.Borrow[id]
+        _count_borrow(borrow, -1)
+        borrow.set(returntime=utils.new_borrowtime())
     except AssertionError:
         message = 'Already returned.'
         raise Fault(409, message)
@@ -717,6 +1008,47 @@ def del_borrow(*args, **kwargs):
     return _del_borrow(*args, **kwargs)
 
 
+@utils.changes('Borrow')
+@orm.db_session
+def _del_borrow(id):
+    borrow = db.Borrow[id]
+    _count_borrow(borrow, -1)
+    borrow.delete()
+
+
+@d.add_method
+@utils.catch_error
+@utils.check_admin
+def check_borrow(*args, **kwargs):
+    return _check_borrow(*args, **kwargs)
+
+
 @orm.db_session
-def _del_borrow():
-    db.Borrow[id].delete()
+def _check_borrow(repair=False):
+    """Compare the counters with the open borrows.
+    Return the differences and rebuild them on repair."""
+    opened = orm.select((x.user.id, orm.count(x)) for x in db.Borrow
+                        if x.returntime is None)
+    lent = orm.select((x.storage.id, orm.max(x.id)) for x in db.Borrow
+                      if x.returntime is None)
+    quotas = {x.user: x for x in db.Quota.select_db()}
+    lendings = {x.storage: x for x in db.Lending.select_db()}
+    result = {'quota': _compare(quotas, 'opened', dict(opened[:])),
+              'lending': _compare(lendings, 'borrow', dict(lent[:]))}
+    if repair:
+        for user, _, count in result['quota']:
+            quota = quotas.get(user) or db.Quota(user=user, opened=0)
+            quota.opened = count or 0
+        for storage, _, borrow in result['lending']:
+            lending = lendings.get(storage) or db.Lending(storage=storage)
+            lending.borrow = borrow
+    return result
+
+
+def _compare(stored, key, actual):
+    """List the [id, stored, actual] that differ.
+    The zero counts and the empty pointers are missing."""
+    stored = {k: getattr(v, key) for k, v in stored.items() if getattr(v, key)}
+    keys = sorted(set(stored) | set(actual))
+    return [[k, stored.get(k), actual.get(k)] for k in keys
+            if stored.get(k) != actual.get(k)]
@@ -0,0 +1,128 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+from pony import orm
+
+from sni import db, utils
+
+
+class Index:
+    """A trigram FTS5 index over the text columns of a table.
+    It is kept in sync with the table by triggers."""
+    def __init__(self, table, columns):
+        self.table = table
+        self.name = table + 'Index'
+        self.columns = columns
+        self.available = False
+
+    def ddl(self):
+        values = ', '.join(self.columns)
+        news = ', '.join('new.' + x for x in self.columns)
+        olds = ', '.join('old.' + x for x in self.columns)
+        create = 'CREATE VIRTUAL TABLE "{0}" USING fts5({1}, ' \
+                 'content="{2}", content_rowid="id", ' \
+                 'tokenize="trigram case_sensitive 1")'
+        insert = 'INSERT INTO "{0}"(rowid, {1}) VALUES (new.id, {2});'
+        delete = 'INSERT INTO "{0}"("{0}", rowid, {1}) ' \
+                 'VALUES (\'delete\', old.id, {2});'
+        trigger = 'CREATE TRIGGER "{0}_{1}" AFTER {2} ON "{3}" ' \
+                  'BEGIN {4} END'
+        insert = insert.format(self.name, values, news)
+        delete = delete.format(self.name, values, olds)
+        yield create.format(self.name, values, self.table)
+        yield trigger.format(self.name, 'ai', 'INSERT', self.table, insert)
+        yield trigger.format(self.name, 'ad', 'DELETE', self.table, delete)
+        yield trigger.format(self.name, 'au', 'UPDATE', self.table, delete + insert)
+
+    @orm.db_session
+    def create(self):
+        """Create the index if it is missing.
+        Fall back to scanning if FTS5 is not supported."""
+        sql = 'SELECT count(*) FROM sqlite_master WHERE name = $name'
+        if db.db.select(sql, {'name': self.name})[0]:
+            self.available = True
+            return
+        try:
+            for x in self.ddl(): db.db.execute(x)
+            self.rebuild()
+            self.available = True
+        except orm.core.DatabaseError as e:
+            print(type(e), str(e.args))
+            db.db.rollback()
+            self.available = False
+
+    @orm.db_session
+    def drop(self):
+        for x in ('ai', 'ad', 'au'):
+            db.db.execute('DROP TRIGGER IF EXISTS "{0}_{1}"'.format(self.name, x))
+        db.db.execute('DROP TABLE IF EXISTS "{0}"'.format(self.name))
+        self.available = False
+
+    @orm.db_session
+    def rebuild(self):
+        sql = 'INSERT INTO "{0}"("{0}") VALUES (\'rebuild\')'
+        db.db.execute(sql.format(self.name))
+
+    @staticmethod
+    def phrase(text):
+        return '"{0}"'.format(text.replace('"', '""'))
+
+    def search(self, terms, filters, limit=None, after=None, ranked=True):
+        """Get the page of ids of the rows matching all the terms.
+        The terms are (columns, text) pairs, every text must be
+        a substring of one of the columns. Rows are ranked by BM25
+        if any text is long enough for the trigram index, then the
+        cursor is the offset, otherwise it is the last id."""
+        params, where, match = {}, [], []
+        for i, (columns, text) in enumerate(terms):
+            params['t{0}'.format(i)] = text
+            if len(text) >= 3:
+                columns = ' '.join(columns)
+                match.append('{{{0}}} : {1}'.format(columns, self.phrase(text)))
+            else:
+                where.append(' OR '.join('instr(x."{0}", $t{1}) > 0'.format(x, i)
+                                         for x in columns))
+        for key, value in filters.items():
+            params[key] = value
+            where.append('x."{0}" = ${0}'.format(key))
+        ranked = ranked and bool(match)
+        if after is not None and not ranked:
+            params['after'] = after
+            where.append('x.id > $after')
+        if match:
+            params['match'] = ' AND '.join(match)
+            where.insert(0, '"{0}" MATCH $match')
+            source = '"{0}" JOIN "{1}" x ON x.id = "{0}".rowid'
+        else:
+            source = '"{1}" x'
+        order = '"{0}".rank' if ranked else 'x.id'
+        sql = 'SELECT x.id FROM ' + source
+        if where: sql += ' WHERE (' + ') AND ('.join(where) + ')'
+        sql = (sql + ' ORDER BY ' + order).format(self.name, self.table)
+        if limit is not None:
+            params['limit'] = limit + 1
+            params['offset'] = (after or 0) if ranked else 0
+            sql += ' LIMIT $limit OFFSET $offset'
+        ids = db.db.select(sql, params)
+        if limit is None or len(ids) <= limit: return utils.Page(ids)
+        ids = ids[:limit]
+        next = (after or 0) + limit if ranked else ids[-1]
+        return utils.Page(ids, next)
+
+
+articles = Index('Article', ('title', 'author',
+                             'keyword1', 'keyword2', 'keyword3',
+                             'keyword4', 'keyword5'))
+journals = Index('Journal', ('name', 'addr', 'used'))
+indexes = [articles, journals]
+
+
+def create_indexes():
+    for x in indexes: x.create()
+
+
+def drop_indexes():
+    for x in indexes: x.drop()
+
+
+def rebuild_indexes():
+    for x in indexes: x.rebuild()
@@ -0,0 +1,138 @@
+#!/usr/bin/env/python3
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+from time import perf_counter
+
+from sni import db
+
+# the hooks only check this flag when profiling is disabled
+enabled = False
+state = local()
+LAYERS = ('auth', 'sql', 'to_dict', 'encode')
+
+
+class Call:
+    """The timing spans of one call of a method.
+    The spans may nest, e.g. to_dict may run SQL."""
+    def __init__(self, method, count=1):
+        self.method = method
+        self.count = count
+        self.spans = dict.fromkeys(LAYERS, 0.0)
+        self.queries = 0
+        self.total = 0.0
+
+    def __enter__(self):
+        stat = db.db.local_stats[None]
+        self.sql = stat.db_count, stat.sum_time
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.total += perf_counter() - self.start
+        stat = db.db.local_stats[None]
+        self.queries += stat.db_count - self.sql[0]
+        self.spans['sql'] += stat.sum_time - self.sql[1]
+
+    def to_dict(self):
+        result = {'method': self.method, 'total': round(self.total, 6)}
+        result.update((k, round(v, 6)) for k, v in self.spans.items())
+        result['queries'] = self.queries
+        return result
+
+
+class Span:
+    """Add the time of the block to the current call."""
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if enabled: self.start = perf_counter()
+
+    def __exit__(self, *args):
+        call = enabled and getattr(state, 'call', None)
+        if call: call.spans[self.name] += perf_counter() - self.start
+
+
+@contextmanager
+def resume(call):
+    """Add the block to the call, e.g. a page of its stream."""
+    if call is None:
+        yield
+        return
+    state.call = call
+    try:
+        with call:
+            yield
+    finally:
+        state.call = None
+
+
+def track(name, function):
+    """Wrap the method to record its spans."""
+    @wraps(function)
+    def _track(*args, **kwargs):
+        calls = getattr(state, 'calls', None)
+        if not enabled or calls is None: return function(*args, **kwargs)
+        state.call = Call(name)
+        calls.append(state.call)
+        try:
+            with state.call:
+                return function(*args, **kwargs)
+        finally:
+            state.call = None
+    return _track
+
+
+def instrument(dispatcher):
+    for name, function in list(dispatcher.items()):
+        dispatcher[name] = track(name, function)
+
+
+def begin():
+    state.calls = []
+    state.call = None
+
+
+def end(encode=0.0):
+    """Aggregate the calls of the request and return them.
+    The encoding is counted for the single call only."""
+    calls = state.calls
+    state.calls = None
+    if len(calls) == 1:
+        calls[0].spans['encode'] += encode
+        calls[0].total += encode
+    for x in calls: registry.add(x)
+    return {'calls': [x.to_dict() for x in calls[:100]],
+            'encode': round(encode, 6)}
+
+
+class Registry:
+    """Sum the spans per method, the stats are the means."""
+    def __init__(self):
+        self.lock = Lock()
+        self.methods = {}
+
+    def add(self, call):
+        with self.lock:
+            total = self.methods.setdefault(call.method, Call(call.method, 0))
+            for k, v in call.spans.items(): total.spans[k] += v
+            total.queries += call.queries
+            total.total += call.total
+            total.count += 1
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for name, x in self.methods.items():
+                means = {k: round(v / x.count, 6) for k, v in x.spans.items()}
+                means['total'] = round(x.total / x.count, 6)
+                means['queries'] = round(x.queries / x.count, 2)
+                result[name] = dict(calls=x.count, **means)
+            return result
+
+
+registry = Registry()
@@ -1,21 +1,31 @@
 #!/usr/bin/env/python3
 # -*- coding: utf-8 -*-
 from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import wraps
 from hashlib import sha256
+from threading import BoundedSemaphore, Lock, Semaphore
+from time import sleep
 from uuid import uuid1
 
 import bcrypt
 from jsonrpc import exceptions
-from pony.orm import core
+from pony import orm
+from pony.orm import core, dbapiprovider
 
-from sni import db
+from sni import db, timing
+from sni.cache import LRUCache, ResponseCache
+
+# sessionid -> (user, role, shelflife)
+sessions = LRUCache(size=4096, ttl=60)
+# (arguments, generations) -> encoded result per method
+responses = ResponseCache()
 
 
 class Fault(exceptions.JSONRPCDispatchException):
-    def __init__(self, code, message, details=None):
-        super().__init__(code, message.format(details))
+    def __init__(self, code, message, details=None, data=None):
+        super().__init__(code, message.format(details), data)
         self.args = self.error.code, self.error.message
 
 
@@ -33,7 +43,8 @@ def catch_error(function):
         except core.ConstraintError as e:
             message = 'Constraint error: {0}'
             raise Fault(409, message, e.args)
-        except core.TransactionIntegrityError as e:
+        except (core.TransactionIntegrityError, core.CacheIndexError,
+                dbapiprovider.IntegrityError) as e:
             message = 'Integrity error: {0}'
             raise Fault(409, message, e.args)
         except core.ObjectNotFound as e:
@@ -46,13 +57,168 @@ def catch_error(function):
     return _catch_error
 
 
+class Page(list):
+    """A page of the results with the cursor of the next one.
+    The cursor is None if there is no more result."""
+    size = 1000
+
+    def __init__(self, items=(), next=None, paged=False):
+        super().__init__(items)
+        self.next = next
+        self.paged = paged
+
+    @classmethod
+    def limit(cls, limit=None):
+        """Bound the limit by the maximum size."""
+        if limit is None: return cls.size
+        if limit <= 0: raise ValueError('limit', limit)
+        return min(limit, cls.size)
+
+    def map(self, function):
+        return Page(map(function, self), self.next, self.paged)
+
+
+def paginate(query, limit=None, after=None):
+    """Get the page of the query after the cursor.
+    The query is ordered by id, the cursor is the last id."""
+    paged = limit is not None or after is not None
+    limit = Page.limit(limit)
+    if after is not None:
+        query = query.filter(lambda x: x.id > after)
+    items = query.order_by(lambda x: x.id)[:limit + 1]
+    next = items[limit - 1].id if len(items) > limit else None
+    return Page(items[:limit], next, paged)
+
+
+class Stream:
+    """A result iterated while the response is sent.
+    The hooks get the error code, or None, once it ends or is closed."""
+    def __init__(self, items):
+        self.items = items
+        self.hooks = []
+
+    def __iter__(self):
+        code = None
+        try:
+            yield from self.items
+        except Exception:
+            code = 500
+            raise
+        finally:
+            self.close(code)
+
+    def close(self, code=None):
+        hooks, self.hooks = self.hooks, []
+        for x in hooks: x(code)
+
+
+def iter_pages(function, call, *args, **kwargs):
+    """Fetch all the pages again, each in its own db_session after
+    the cursor of the one before, and add them to the call. Nothing
+    is left open on the thread while a page is sent, as bjoern serves
+    the other requests on it in between."""
+    after = None
+    while True:
+        with timing.resume(call):
+            page = db.read_only(function, *args, **dict(kwargs, after=after))
+        yield from page
+        after = page.next
+        if after is None: return
+
+
+def paged(function):
+    """Wrap a paged result with the next cursor.
+    Unpaged results longer than a page are streamed."""
+    @wraps(function)
+    def _paged(*args, **kwargs):
+        result = function(*args, **kwargs)
+        if result.paged:
+            return {'items': list(result), 'next': result.next}
+        if result.next is None: return result
+        call = getattr(timing.state, 'call', None)
+        return Stream(iter_pages(function, call, *args, **kwargs))
+    return _paged
+
+
+class Encoded(str):
+    """A result already encoded as JSON."""
+
+
+def cached(*entities):
+    """Cache the encoded results of the method by its arguments,
+    as long as the entities are unchanged. Streams are not cached."""
+    def _cached(function):
+        @wraps(function)
+        def __cached(*args, **kwargs):
+            cache = responses.cache(function.__name__)
+            if cache is None: return function(*args, **kwargs)
+            key = responses.key(entities, args, kwargs)
+            result = cache.get(key)
+            if result is None:
+                result = function(*args, **kwargs)
+                if isinstance(result, Stream): return result
+                result = Encoded(responses.encode(result))
+                cache.put(key, result)
+            return result
+        return __cached
+    return _cached
+
+
+def changes(*entities):
+    """Bump the generations of the entities after the commit,
+    which is at the end of the batch if the call is in one.
+    All of them are bumped if none is given."""
+    def _changes(function):
+        @wraps(function)
+        def __changes(*args, **kwargs):
+            try:
+                return function(*args, **kwargs)
+            finally:
+                responses.bump(*entities)
+                if getattr(db.state, 'batch', False):
+                    db.state.changes.append(entities)
+        return __changes
+    return _changes
+
+
+def reads(function):
+    """Route the method to the read-only connections.
+    Its session is checked in the cache."""
+    @wraps(function)
+    def _reads(*args, **kwargs):
+        reads = getattr(db.state, 'reads', False)
+        db.state.reads = True
+        try:
+            return db.read_only(function, *args, **kwargs)
+        finally:
+            db.state.reads = reads
+    return _reads
+
+
+def load_session(sessionid, cached=True):
+    """Get the (user, role, shelflife) of the session.
+    The database is hit when the cache misses or is not used,
+    as the other processes do not drop their cached sessions."""
+    result = sessions.get(sessionid) if cached else None
+    if result is None:
+        with orm.db_session:
+            assert isinstance(sessionid, str)
+            session = db.Session.get(sessionid=sessionid)
+            assert session is not None
+            user = session.user
+            result = user.id, type(user).__name__, session.shelflife
+        sessions.put(sessionid, result)
+    return result
+
+
 def check_session(function):
     @wraps(function)
     def _check_session(sessionid, *args, **kwargs):
         try:
-            assert db.Session.exists(sessionid=sessionid)
-            session = db.Session.get(sessionid=sessionid)
-            assert datetime.now() <= session.shelflife
+            with timing.Span('auth'):
+                cached = getattr(db.state, 'reads', False)
+                user, role, shelflife = load_session(sessionid, cached)
+                assert datetime.now() <= shelflife
             return function(sessionid, *args, **kwargs)
         except AssertionError:
             message = 'Invalid session.'
@@ -60,60 +226,203 @@ def check_session(function):
     return _check_session
 
 
-def check_user(function):
-    @check_session
-    @wraps(function)
-    def _check_user(session, *args, **kwargs):
+def check_role(entity, message):
+    """Generate a decorator to check the role.
+    The role is read from the cached session, except the admin."""
+    def _check_role(function):
+        @check_session
+        @wraps(function)
+        def __check_role(session, *args, **kwargs):
+            try:
+                with timing.Span('auth'):
+                    user, role, shelflife = load_session(session, entity != 'Admin')
+                    assert issubclass(getattr(db, role), getattr(db, entity))
+                return function(*args, **kwargs)
+            except AssertionError:
+                raise Fault(403, message)
+        return __check_role
+    return _check_role
+
+
+check_user = check_role('User', 'User required.')
+check_admin = check_role('Admin', 'Admin required.')
+check_reader = check_role('Reader', 'Reader required.')
+
+
+class Hasher:
+    """Run bcrypt in a worker pool with a bounded queue, the calls
+    beyond it get 503. Set the workers to 0 to run it inline."""
+    def __init__(self, rounds=12, workers=2, queue=64, pool='thread'):
+        self.rounds = rounds
+        self.workers = workers
+        self.queue = queue
+        self.pool = pool
+        self.executor = None
+        self.pending = 0
+        self.rejected = 0
+        self.lock = Lock()
+        self.shutdown()
+
+    def configure(self, rounds=None, workers=None, queue=None, pool=None):
+        self.rounds = rounds or self.rounds
+        self.workers = self.workers if workers is None else workers
+        self.queue = self.queue if queue is None else queue
+        self.pool = pool or self.pool
+        self.shutdown()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.executor = None
+        self.slots = BoundedSemaphore(self.workers + self.queue)
+
+    def run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        with self.lock:
+            if self.executor is None:
+                pools = {'thread': ThreadPoolExecutor,
+                         'process': ProcessPoolExecutor}
+                self.executor = pools[self.pool](self.workers)
+        if not self.slots.acquire(blocking=False):
+            with self.lock: self.rejected += 1
+            message = 'Server busy, retry after {0}s.'
+            raise Fault(503, message, admission.retry, {'retry': admission.retry})
         try:
-            session = db.Session.get(sessionid=session)
-            assert db.User.exists(id=session.user.id)
-            return function(*args, **kwargs)
-        except AssertionError:
-            message = 'User required.'
-            raise Fault(403, message)
-    return _check_user
+            with self.lock: self.pending += 1
+            try:
+                return self.executor.submit(function, *args).result()
+            finally:
+                with self.lock: self.pending -= 1
+        finally:
+            self.slots.release()
 
+    def stats(self):
+        return {'rounds': self.rounds,
+                'workers': self.workers,
+                'pending': self.pending,
+                'rejected': self.rejected}
 
-def check_admin(function):
-    @check_session
-    @wraps(function)
-    def _check_admin(session, *args, **kwargs):
-        try:
-            session = db.Session.get(sessionid=session)
-            assert db.Admin.exists(id=session.user.id)
-            return function(*args, **kwargs)
-        except AssertionError:
-            message = 'Admin required.'
-            raise Fault(403, message)
-    return _check_admin
 
+hasher = Hasher()
 
-def check_reader(function):
-    @check_session
-    @wraps(function)
-    def _check_reader(session, *args, **kwargs):
-        try:
-            session = db.Session.get(sessionid=session)
-            assert db.Reader.exists(id=session.user.id)
-            return function(*args, **kwargs)
-        except AssertionError:
-            message = 'Reader required.'
-            raise Fault(403, message)
-    return _check_reader
 
-
-def hash_pw(pw: str) -> str:
+def _hash_pw(pw, rounds):
     pw_sha256 = b64encode(sha256(pw.encode('utf-8')).digest())
-    pw_bcrypt = bcrypt.hashpw(pw_sha256, bcrypt.gensalt())
+    pw_bcrypt = bcrypt.hashpw(pw_sha256, bcrypt.gensalt(rounds))
     return pw_bcrypt.decode('utf-8')
 
 
-def check_pw(pw: str, pw_hashed: str) -> bool:
+def _check_pw(pw, pw_hashed):
+    if not pw_hashed.startswith('$2'): return False
     pw_sha256 = b64encode(sha256(pw.encode('utf-8')).digest())
     pw_bcrypt = pw_hashed.encode('utf-8')
     return bcrypt.checkpw(pw_sha256, pw_bcrypt)
 
 
+def hash_pw(pw: str) -> str:
+    return hasher.run(_hash_pw, pw, hasher.rounds)
+
+
+def check_pw(pw: str, pw_hashed: str) -> bool:
+    return hasher.run(_check_pw, pw, pw_hashed)
+
+
+def needs_rehash(pw_hashed: str) -> bool:
+    """Check if the hash uses another cost.
+    The cost is the second field of the hash."""
+    return int(pw_hashed.split('$')[2]) != hasher.rounds
+
+
+class Limit:
+    """Run at most limit calls at once, with at most queue calls
+    waiting for up to wait seconds. The rest are rejected at once."""
+    def __init__(self, limit, queue=0, wait=1.0):
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.slots = Semaphore(limit)
+        self.lock = Lock()
+        self.admitted = 0
+        self.running = 0
+        self.rejected = 0
+
+    def enter(self):
+        with self.lock:
+            if self.admitted >= self.limit + self.queue:
+                self.rejected += 1
+                return False
+            self.admitted += 1
+        if self.slots.acquire(timeout=self.wait):
+            with self.lock: self.running += 1
+            return True
+        with self.lock:
+            self.admitted -= 1
+            self.rejected += 1
+        return False
+
+    def exit(self):
+        with self.lock:
+            self.running -= 1
+            self.admitted -= 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {'limit': self.limit, 'queue': self.queue,
+                    'running': self.running, 'waiting': self.admitted - self.running,
+                    'rejected': self.rejected}
+
+
+class Admission:
+    """Limit the concurrent calls of each class of methods.
+    The rejected calls get 503 with the seconds to retry after,
+    the methods of no class are never limited. A streamed result
+    holds its slot until it is sent."""
+    CLASSES = {'auth': ('sign_in', 'sign_up'),
+               'search': ('get_user_advanced', 'get_journal_advanced', 'get_article_advanced'),
+               'bulk': ('import_catalog', 'export_catalog')}
+
+    def __init__(self, retry=1.0):
+        self.retry = retry
+        self.limits = {}
+
+    def configure(self, name, limit=0, queue=0, wait=1.0):
+        """Set the limit of the class, 0 for no limit."""
+        if limit > 0: self.limits[name] = Limit(limit, queue, wait)
+        else: self.limits.pop(name, None)
+
+    def admit(self, name, function):
+        @wraps(function)
+        def _admit(*args, **kwargs):
+            limit = self.limits.get(name)
+            if limit is None: return function(*args, **kwargs)
+            if not limit.enter():
+                message = 'Server busy, retry after {0}s.'
+                raise Fault(503, message, self.retry, {'retry': self.retry})
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                if isinstance(result, Stream):
+                    result.hooks.append(lambda code: limit.exit())
+                else:
+                    limit.exit()
+        return _admit
+
+    def instrument(self, dispatcher):
+        for name, methods in self.CLASSES.items():
+            for x in methods:
+                if x in dispatcher: dispatcher[x] = self.admit(name, dispatcher[x])
+
+    def stats(self):
+        return {k: v.stats() for k, v in self.limits.items()}
+
+
+admission = Admission()
+
+
 def new_shelflife(hours=12):
     """Generate a shelflife with given hours.
     Set the hours to 0 to make it expired."""
@@ -128,11 +437,34 @@ def new_session(user):
 
 
 def update_session(user):
+    # the session may have been reaped
+    if user.session is None: return new_session(user)
+    sessions.pop(user.session.sessionid)
     user.session.sessionid = uuid1().hex
     user.session.shelflife = new_shelflife()
     return user.session
 
 
+def reap_sessions(batch=500, pause=0.01):
+    """Delete the expired sessions in short transactions of the batch size,
+    so that the writers can go between. Return the deleted count and
+    the live and expired counts before, all of them found by the index."""
+    count = 'COUNT(*) FROM "Session" WHERE "shelflife" {0} $now'
+    delete = 'DELETE FROM "Session" WHERE "id" IN (SELECT "id" FROM "Session" ' \
+             'WHERE "shelflife" < $now LIMIT $batch)'
+    params = {'now': str(datetime.now()), 'batch': batch}
+    with orm.db_session:
+        result = {'live': db.db.select(count.format('>='), params)[0],
+                  'expired': db.db.select(count.format('<'), params)[0],
+                  'deleted': 0}
+    while True:
+        with orm.db_session:
+            deleted = db.db.execute(delete, params).rowcount
+        result['deleted'] += deleted
+        if deleted < batch: return result
+        sleep(pause)
+
+
 def check_regex(regex):
     """Generate a function to match the regex.
     The regex will be compiled to speed up."""
@@ -1,6 +1,17 @@
 #!/usr/bin/env/python3
 # -*- coding: utf-8 -*-
-from sni import db, rpc
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from time import time
+
+from pony import orm
+
+from bench import generate
+from sni import aio, app, cache, db, jobs, metrics, prefork, rpc, search, timing
 from tests import utils
 
 sign_up = utils.ignore_error(rpc._sign_up)
@@ -75,6 +86,297 @@ def test_articles(articles, storage):
         get_article_adv(id=id)
 
 
+def test_search():
+    rpc._rebuild_index()
+    for x in ('出版', '士绅', '县志 出版'):
+        found = get_article_adv(keywords=x)
+        found = sorted(found, key=lambda x: x['id'])
+        with orm.db_session:
+            assert found == rpc._scan_article_advanced(None, None, x, None, None)
+    # the terms of 3 characters or more go through the index
+    for x in ('改革开放', '中国特色 社会主义', '论坛 中国社会科学院', '社会科学院'):
+        found = get_article_adv(keywords=x)
+        with orm.db_session:
+            assert found and sorted(found, key=lambda x: x['id']) == \
+                rpc._scan_article_advanced(None, None, x, None, None)
+            search.articles.search([(search.articles.columns[2:], x.split()[-1])], {})
+            assert 'MATCH' in db.db.last_sql
+    print(get_article_adv(title='出版', limit=2))
+    for x in ('史', '北京市', '研究'):
+        found = rpc._get_journal_advanced(addr=x)
+        assert all(x in y['addr'] for y in found)
+        assert len(found) == len([y for y in get_journal() if x in y['addr']])
+        with orm.db_session:
+            assert found == rpc._scan_journal_advanced(None, x, None, None, None)
+        page = rpc._get_journal_advanced(addr=x, limit=1)
+        assert page == found[:1] and (page.next is None) == (len(found) <= 1)
+        # the page is cut in SQL, not by a list of the matching ids
+        with orm.db_session:
+            search.journals.search([(('addr',), x)], {}, 1, ranked=False)
+            assert 'LIMIT' in db.db.last_sql and ('MATCH' in db.db.last_sql) == (len(x) >= 3)
+
+
+def test_pages():
+    get_page = rpc.utils.paged(rpc._get_article)
+    ids, after = [], None
+    while True:
+        page = get_page(limit=40, after=after)
+        ids += [x['id'] for x in page['items']]
+        after = page['next']
+        if after is None: break
+    assert ids == [x['id'] for x in get_article()]
+    size, rpc.utils.Page.size = rpc.utils.Page.size, 40
+    registry = metrics.Registry(sample=0)
+    stream = registry.track('get_article', get_page)()
+    assert registry.snapshot()['methods']['get_article']['inflight'] == 1
+    assert ids == [x['id'] for x in stream]
+    result = registry.snapshot()['methods']['get_article']
+    assert result['inflight'] == 0 and result['calls'] == 1
+    # the requests served between the pages write as usual
+    items = iter(get_page())
+    next(items)
+    writer = db.db.provider.pool.con
+    assert orm.core.local.db_session is None
+    journal = get_journal(1)[0]
+    rpc._set_journal(1, addr='北京东城区')
+    assert db.db.provider.pool.con is writer
+    assert len(list(items)) == len(ids) - 1
+    assert get_journal(1)[0]['addr'] == '北京东城区'
+    rpc._set_journal(1, addr=journal['addr'])
+    rpc.utils.Page.size = size
+
+
+def test_full():
+    def count(func, *args):
+        return utils.count_queries(db.db, func, *args)
+    assert count(get_subscribe_full, 1) == count(get_subscribe_full)
+    assert count(get_storage_full, 1) == count(get_storage_full)
+    assert count(get_user_advanced, 1) == count(get_user_advanced)
+
+
+def test_batch():
+    journal = ('期刊', '0000-0000', 'CN00-0000', '0-0', '主办', '地址', 12, '中文')
+    with db.batch():
+        id = add_journal(*journal)
+        assert get_journal(id)
+        orm.rollback()
+    assert not get_journal(id)
+    with db.batch():
+        id = add_journal(*journal)
+    assert get_journal(id)
+    rpc._del_journal(id)
+    session = sign_in('A00000000', '12345678')
+    def call(id, method, *params):
+        result = {'jsonrpc': '2.0', 'method': method, 'params': [session] + list(params)}
+        if id is not None: result['id'] = id
+        return result
+    name = get_journal(1)[0]['name']
+    issn = get_journal(2)[0]['issn']
+    batch = [call(1, 'add_journal', *journal),
+             call(2, 'add_journal', *journal),
+             call(None, 'set_journal', 1, '改名', issn),
+             call(3, 'add_journal', '期刊二', '0000-0001', 'CN00-0001', '0-1', *journal[4:])]
+    responses = app.handle(json.dumps(batch)).data
+    assert [x['id'] for x in responses] == [1, 2, 3]
+    assert responses[1]['error']['code'] == 409 and 'error' not in responses[2]
+    ids = responses[0]['result'], responses[2]['result']
+    assert get_journal(ids[0]) and get_journal(ids[1])
+    assert get_journal(1)[0]['name'] == name
+    for x in ids: rpc._del_journal(x)
+    batch = [call(1, 'add_journal', *journal), call(2, 'set_journal', 1, '改名', issn),
+             call(3, 'add_journal', '期刊二', '0000-0001', 'CN00-0001', '0-1', *journal[4:])]
+    responses = app.handle(json.dumps(batch), atomic=True).data
+    assert [x['error']['code'] for x in responses] == [409, 409, 409]
+    assert responses[0]['error']['message'] == 'Batch rolled back.'
+    assert responses[1]['error']['message'] != 'Batch rolled back.'
+    with orm.db_session:
+        assert not db.Journal.exists_db(issn=journal[1])
+
+
+def test_cache():
+    session = sign_in('A00000000', '12345678')
+    first = rpc.get_journal(session, limit=2)
+    assert rpc.get_journal(session, limit=2, after=None) is first
+    set_journal(1, used='缓存')
+    second = rpc.get_journal(session, limit=2)
+    assert second is not first
+    assert json.loads(second)['items'][0]['used'] == '缓存'
+    with db.batch():
+        set_journal(1, used='')
+    assert json.loads(rpc.get_journal(session, limit=2))['items'][0]['used'] == ''
+    shared = rpc.utils.responses.shared
+    with tempfile.TemporaryDirectory() as path:
+        rpc.utils.responses.share(os.path.join(path, 'cache'))
+        try:
+            first = rpc.get_journal(session, limit=2)
+            assert rpc.get_journal(session, limit=2) is first
+            # another process commits a change
+            open(os.path.join(path, 'cache'), 'a').close()
+            assert rpc.get_journal(session, limit=2) is not first
+        finally:
+            rpc.utils.responses.share(shared)
+    responses = cache.ResponseCache()
+    responses.configure(ttl=0)
+    assert responses.cache('get_journal') is None
+    print(rpc.utils.responses.stats())
+
+
+def test_import(filename):
+    data = utils.load_ordered(filename)
+    rpc._import_catalog(data)
+    report = rpc._import_catalog(data)
+    assert not any(report['counts'].values())
+    print(report['errors'])
+    records = list(rpc._export_catalog())
+    report = rpc._import_catalog(records)
+    assert not any(report['counts'].values()) and not report['errors']
+    # two borrows of a copy on one day are kept apart
+    user = next(x['id'] for x in records if x['entity'] == 'User')
+    storage = next(x['id'] for x in records if x['entity'] == 'Storage')
+    borrow = {'entity': 'Borrow', 'borrowtime': '2001-01-01 00:00:00', 'user': user,
+              'agreedtime': '2001-02-01 00:00:00', 'returntime': '2001-01-02 00:00:00',
+              'storage': storage}
+    report = rpc._import_catalog(records + [borrow, borrow])
+    assert report['counts']['Borrow'] == 2 and not report['errors']
+    report = rpc._import_catalog(records + [borrow, borrow])
+    assert not any(report['counts'].values())
+    with orm.db_session:
+        orm.delete(x for x in db.Borrow if x.borrowtime == datetime(2001, 1, 1))
+    journal = {'name': '期刊', 'issn': '0000-0000', 'isbn': 'CN00-0000', 'post': '0-0',
+               'host': '主办', 'addr': '地址', 'freq': 12, 'lang': '中文'}
+    report = rpc._import_catalog([journal, dict(journal, issn='0000-0001')])
+    assert report['counts']['Journal'] == 1 and len(report['errors']) == 1
+    with orm.db_session:
+        id = db.Journal.get(issn='0000-0000').id
+    rpc._del_journal(id)
+
+
+def test_metrics():
+    registry = metrics.Registry(sample=0)
+    get_journal = registry.track('get_journal', rpc.get_journal)
+    session = sign_in('A00000000', '12345678')
+    for x in range(10): get_journal(session, id=1)
+    utils.ignore_error(get_journal)('invalid', id=1)
+    result = registry.snapshot()['methods']['get_journal']
+    assert result['calls'] == 11 and result['errors'][401] == 1
+    assert result['inflight'] == 0 and result['p50'] <= result['p99']
+    print(result)
+    def fail():
+        yield 1
+        raise ValueError()
+    stream = registry.track('fail', lambda: rpc.utils.Stream(fail()))()
+    try:
+        list(stream)
+        assert False
+    except ValueError:
+        assert registry.snapshot()['methods']['fail']['errors'][500] == 1
+    stream = registry.track('fail', lambda: rpc.utils.Stream(fail()))()
+    stream.close()
+    assert registry.snapshot()['methods']['fail']['inflight'] == 0
+
+
+def test_timing():
+    timing.enabled = True
+    try:
+        get_journal = timing.track('get_journal', rpc.get_journal)
+        session = sign_in('A00000000', '12345678')
+        rpc.utils.responses.clear()
+        timing.begin()
+        get_journal(session, id=1)
+        result = timing.end()['calls'][0]
+        assert result['queries'] and result['auth'] and result['to_dict']
+        print(result, timing.registry.stats())
+    finally:
+        timing.enabled = False
+
+
+def test_prefork():
+    prefork.run_once(print, 'Forked.')
+    try:
+        prefork.run_once(exit, 1)
+        assert False
+    except RuntimeError as e:
+        print(e)
+    directory = tempfile.mkdtemp(prefix='sni-')
+    target = lambda index, name: open(os.path.join(directory, name + str(index)), 'w').close()
+    supervisor = prefork.Supervisor(2, target, 'worker')
+    for index in range(supervisor.workers): supervisor.spawn(index)
+    assert sorted(x[0] for x in supervisor.children.values()) == [0, 1]
+    for pid in supervisor.children: assert os.waitpid(pid, 0)[1] == 0
+    assert sorted(os.listdir(directory)) == ['worker0', 'worker1']
+
+
+def test_sqlite():
+    with orm.db_session:
+        for key in db.pragmas:
+            print(key, db.db.execute('PRAGMA ' + key).fetchone())
+        assert db.db.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    try:
+        db.bind_sqlite(synchronous='off; DROP TABLE User')
+        assert False
+    except ValueError as e:
+        print(e)
+
+
+def test_snapshot():
+    filename = os.path.join(tempfile.mkdtemp(), 'snapshot.db')
+    print(db.snapshot(filename, pages=16))
+    connection = sqlite3.connect(filename)
+    try:
+        assert connection.execute('PRAGMA integrity_check').fetchone() == ('ok',)
+        with orm.db_session:
+            count = orm.count(x for x in db.Journal)
+        assert connection.execute('SELECT count(*) FROM Journal').fetchone() == (count,)
+    finally:
+        connection.close()
+    assert not os.path.exists(filename + '.tmp')
+
+
+def test_aio():
+    async def read(data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await aio.read_request(reader), await aio.read_request(reader)
+    loop = asyncio.new_event_loop()
+    try:
+        head = b'POST /?atomic=1 HTTP/1.1\r\nContent-Length: 2\r\nConnection: close\r\n\r\n'
+        request, end = loop.run_until_complete(read(head + b'{}'))
+        assert request[4] == b'{}' and end is None
+        assert not aio.keep_alive(request[2], request[3])
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['QUERY_STRING'].encode(), environ['wsgi.input'].read()]
+        server = aio.Server(application, '127.0.0.1', 0, max_body=1)
+        sent = []
+        server.call(server.environ(*request), sent.append, keep=False)
+        assert sent[0].endswith(b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n'
+                                b'8\r\natomic=1\r\n2\r\n{}\r\n')
+        assert sent[1:] == [b'0\r\n\r\n']
+        request = request[:4] + (b'',)
+        sent = []
+        server.call(server.environ(*request), sent.append, keep=False)
+        assert sent == [server.response('200 OK', [('Content-Type', 'text/plain')], b'atomic=1', False)]
+        assert sent[0].endswith(b'Content-Length: 8\r\nConnection: close\r\n\r\natomic=1')
+        try:
+            loop.run_until_complete(read(b'garbage\r\n\r\n'))
+            assert False
+        except aio.BadRequest as e:
+            print(e)
+        async def read_large():
+            reader = asyncio.StreamReader()
+            reader.feed_data(head + b'{}')
+            reader.feed_eof()
+            return await aio.read_request(reader, server.max_body)
+        try:
+            loop.run_until_complete(read_large())
+            assert False
+        except aio.TooLarge as e:
+            print(e, e.status)
+    finally:
+        loop.close()
+
+
 def test_readers():
     sign_up('R00000000', 'Reader', '12345678')
     session = sign_in('R00000000', '12345678')
@@ -84,19 +386,253 @@ def test_readers():
     sign_out(session)
 
 
+def test_sessions():
+    session = sign_in('R00000000', '12345678')
+    rpc.get_user(session)
+    hits = rpc.utils.sessions.hits
+    rpc.get_user(session)
+    assert rpc.utils.sessions.hits > hits
+    # signed out by another process, which keeps the cache here
+    with orm.db_session:
+        db.Session.get(sessionid=session).shelflife = rpc.utils.new_shelflife(0)
+    assert rpc.get_user(session)
+    try:
+        rpc.set_user(session, nickname='Reader')
+        assert False
+    except rpc.Fault as e:
+        assert e.error.code == 401
+    assert get_user(session) is None
+    session = sign_in('R00000000', '12345678')
+    sign_out(session)
+    assert get_user(session) is None
+    print(rpc.utils.sessions.stats())
+    result = rpc.utils.reap_sessions(batch=1)
+    print(result)
+    assert result['deleted'] == result['expired'] >= 1
+    assert rpc.utils.reap_sessions()['deleted'] == 0
+    session = sign_in('R00000000', '12345678')
+    assert get_user(session) is not None
+    assert rpc.get_user(session) and rpc.utils.sessions.get(session)
+    # signed out and reaped by another process
+    with orm.db_session:
+        db.Session.get(sessionid=session).delete()
+    try:
+        rpc.get_user(session)
+        assert False
+    except rpc.Fault as e:
+        assert e.error.code == 401 and rpc.utils.sessions.get(session) is None
+    session = sign_in('R00000000', '12345678')
+    assert get_user(session) is not None
+
+
+def test_rehash():
+    rounds = rpc.utils.hasher.rounds
+    rpc.utils.hasher.configure(rounds=4)
+    sign_in('R00000000', '12345678')
+    user = db.User.get(username='R00000000')
+    assert not rpc.utils.needs_rehash(user.password)
+    rpc.utils.hasher.configure(rounds=rounds)
+    hasher = rpc.utils.Hasher(rounds=4, workers=1, queue=0)
+    hasher.configure(queue=None)
+    assert hasher.queue == 0
+    hasher.slots.acquire()
+    try:
+        hasher.run(rpc.utils._hash_pw, '12345678', 4)
+        assert False
+    except rpc.Fault as e:
+        print(e.args)
+        assert e.error.code == 503 and hasher.stats()['rejected'] == 1
+    hasher.slots.release()
+    assert hasher.run(rpc.utils._check_pw, '12345678', hasher.run(rpc.utils._hash_pw, '12345678', 4))
+    hasher.shutdown()
+
+
 def test_borrow():
     id = add_borrow(1, 1)
     print(get_borrow(id))
     get_borrow_full(id)
     set_borrow(id)
+    assert rpc._is_borrowed(1)
+    assert add_borrow(2, 1) is None
+    end_borrow(id)
+    assert not rpc._is_borrowed(1)
+    id = add_borrow(1, 1)
+    set_borrow(id, storage=2)
+    assert rpc._is_borrowed(2) and not rpc._is_borrowed(1)
+    assert rpc._check_borrow() == {'quota': [], 'lending': []}
+    with orm.db_session:
+        db.Quota[1].opened = 100
+    assert rpc._is_abused(1)
+    print(rpc._check_borrow(repair=True))
+    assert not rpc._is_abused(1)
+    with orm.db_session:
+        orm.delete(x for x in db.Quota)
+        orm.delete(x for x in db.Lending)
+    assert not rpc._is_borrowed(2)
+    db.create_counters()
+    assert rpc._is_borrowed(2) and rpc._check_borrow() == {'quota': [], 'lending': []}
+    rpc._del_borrow(id)
+    assert not rpc._is_borrowed(2)
+    assert rpc._check_borrow() == {'quota': [], 'lending': []}
+
+
+def test_overdue():
+    now = time()
+    id = add_borrow(1, 3, now - 86400 * 40, now - 86400 * 10)
+    overdue = {x['id']: x for x in rpc._get_overdue()}
+    assert overdue[id]['days'] == 10
+    assert overdue[id]['agreedtime'] == get_borrow(id)[0]['agreedtime']
+    assert overdue[id]['agreedtime'].microsecond
+    print(rpc._get_overdue(group=True, limit=1))
+    scheduler = jobs.Scheduler()
+    scheduler.add('overdue', 60, rpc._count_overdue)
+    print(scheduler.run('overdue'))
+    assert scheduler.stats()['overdue']['runs'] == 1
     end_borrow(id)
+    assert id not in {x['id'] for x in rpc._get_overdue()}
+
+
+def test_full_borrows():
+    def count(*args):
+        return utils.count_queries(db.db, get_borrow_full, *args)
+    for x in ('R00000001', 'R00000002', 'R00000003'): sign_up(x, 'Reader', '12345678')
+    with orm.db_session:
+        users = list(orm.select(x.id for x in db.Reader if x.username > 'R00000000'))
+        storages = orm.select(x.id for x in db.Storage).order_by(1)[:6]
+    ids = [add_borrow(users[0], storages[0]), add_borrow(users[1], storages[1])]
+    queries = count()
+    assert len(get_borrow_full()) >= 2 and count(ids[0]) == queries
+    for user, storage in zip(users * 2, storages[2:]):
+        ids.append(add_borrow(user, storage))
+    assert None not in ids and len(get_borrow_full()) >= 6
+    assert count() == queries
+    for x in ids: rpc._del_borrow(x)
+
+
+@orm.db_session
+def test_rows():
+    entities = db.Journal, db.Subscribe, db.Storage, db.Article, db.Borrow
+    for entity in entities:
+        rows = entity.select_rows()
+        dicts = entity.select().map(lambda x: x.to_dict())
+        assert [list(x.items()) for x in rows] == [list(x.items()) for x in dicts]
+        assert rows.next == dicts.next and rows.paged == dicts.paged
+        rows = entity.select_rows(limit=3, after=1)
+        dicts = entity.select(limit=3, after=1).map(lambda x: x.to_dict())
+        assert rows == dicts and rows.next == dicts.next and rows.paged
+    storage = db.Storage[1]
+    rows = db.Article.select_rows(storage=storage, pagenum=10)
+    assert rows == db.Article.select(storage=storage, pagenum=10).map(lambda x: x.to_dict())
+    assert utils.ignore_error(db.Article.select_rows)(volume=1) is None
+
+
+def test_reads():
+    query_only = lambda: db.connection().execute('PRAGMA query_only').fetchone()[0]
+    assert db.read_only(query_only) == 1
+    assert db.read_only(add_journal, '当代亚太', '1007-161X', 'CN11-3706', '2-554',
+                        '中国社会科学院', '北京东城区', 6, '简体中文') is None
+    assert query_only() == 0
+    writer = db.db.provider.pool.con
+    try:
+        db.read_only(next, iter(()))
+    except StopIteration:
+        assert db.db.provider.pool.con is writer
+    # a generator runs after the swap is undone
+    assert list(db.read_only(lambda: (query_only() for _ in range(1)))) == [0]
+    with orm.db_session:
+        assert db.read_only(db.db.get_connection().execute, 'PRAGMA query_only').fetchone() == (0,)
+    session = sign_in('A00000000', '12345678')
+    assert rpc.get_journal(session, id=1)
+
+
+def test_admission():
+    limit = rpc.utils.Limit(1, queue=0)
+    assert limit.enter() and not limit.enter()
+    limit.exit()
+    assert limit.enter()
+    limit.exit()
+    assert limit.stats() == {'limit': 1, 'queue': 0, 'running': 0, 'waiting': 0, 'rejected': 1}
+    admission = rpc.utils.Admission(retry=2.0)
+    admission.configure('auth', 1, 1, wait=0.01)
+    function = admission.admit('auth', lambda: 'Admitted.')
+    assert function() == 'Admitted.'
+    admission.limits['auth'].enter()
+    try:
+        function()
+        assert False
+    except rpc.Fault as e:
+        print(e.args)
+        assert e.error.code == 503 and e.error.data == {'retry': 2.0}
+    finally:
+        admission.limits['auth'].exit()
+    assert admission.stats()['auth']['running'] == 0
+    # an export holds its slot until it is sent
+    admission.configure('bulk', 1, 0)
+    stream = admission.admit('bulk', rpc._export_catalog)()
+    assert admission.stats()['bulk']['running'] == 1
+    assert list(stream) and admission.stats()['bulk']['running'] == 0
+    admission.configure('auth', 0)
+    admission.configure('bulk', 0)
+    assert function() == 'Admitted.' and admission.stats() == {}
+
+
+def test_restart():
+    rpc._restart_world()
+    assert db.template is not None
+    db.save_template()
+    assert os.listdir(os.path.dirname(db.template)) == ['template.db']
+    add_journal('当代亚太', '1007-161X', 'CN11-3706', '2-554',
+                '中国社会科学院', '北京东城区', 6, '简体中文')
+    session = sign_in('A00000000', '12345678')
+    start = time()
+    rpc._restart_world()
+    print('restart', time() - start)
+    try:
+        with orm.db_session:
+            rpc._restart_world()
+        assert False
+    except rpc.Fault as e:
+        print(e.args)
+        assert e.error.code == 409
+    assert get_journal() == [] and get_user(session) is None
+    assert sign_in('A00000000', '12345678')
+    assert add_journal('当代亚太', '1007-161X', 'CN11-3706', '2-554',
+                       '中国社会科学院', '北京东城区', 6, '简体中文') == 1
+
+
+def test_generate():
+    journals = list(generate.catalog(3, years=1, articles=2, seed=1))
+    assert journals == list(generate.catalog(3, years=1, articles=2, seed=1))
+    assert journals != list(generate.catalog(3, years=1, articles=2, seed=2))
+    assert [x['issn'] for x in journals] == ['0000-000X', '0000-001X', '0000-002X']
 
 
 def test_main():
     db.bind_sqlite('../sni.db')
     test_journals('test.json')
+    test_search()
+    test_pages()
+    test_full()
+    test_batch()
+    test_import('test.json')
+    test_cache()
+    test_metrics()
+    test_timing()
+    test_prefork()
+    test_sqlite()
+    test_snapshot()
+    test_aio()
     test_readers()
+    test_sessions()
+    test_rehash()
     test_borrow()
+    test_overdue()
+    test_full_borrows()
+    test_rows()
+    test_reads()
+    test_admission()
+    test_restart()
+    test_generate()
 
 
 if __name__ == '__main__':
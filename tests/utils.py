@@ -28,6 +28,15 @@ def show_coverage(func):
     return _show_coverage
 
 
+def count_queries(database, func, *args, **kwargs):
+    def _count():
+        stats = database.local_stats.values()
+        return sum(x.db_count for x in stats)
+    before = _count()
+    func(*args, **kwargs)
+    return _count() - before
+
+
 def load_ordered(filename):
     decoder = JSONDecoder(object_pairs_hook=OrderedDict)
     return decoder.decode(open(filename).read())